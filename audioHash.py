@@ -0,0 +1,92 @@
+import hashlib
+import mmap
+import os
+import struct
+
+# hash only the audio in a music file, so copies that differ in nothing but their tags hash the same.
+# tag blocks are skipped the way each format stores them:
+#   MP3 and other raw streams: ID3v2 at the start, ID3v1, APEv2 and Lyrics3 at the end
+#   FLAC: the metadata blocks, MP4/M4A: everything but the mdat atoms, WAV: everything but the data chunk
+# other formats are hashed whole. the file is memory mapped and hashed in chunks, so it is never read in at once
+
+def audioHash(filename, chunkSize=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in audioRanges(data, size):
+                for offset in range(start, end, chunkSize):
+                    digest.update(data[offset:min(end, offset + chunkSize)])
+    return digest.hexdigest()
+
+# the (start, end) byte ranges that hold the audio
+def audioRanges(data, size):
+    if data[4:8] == b'ftyp':
+        return chunkRanges(data, size, 0, b'mdat', '>I', False) or [(0, size)]
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        return chunkRanges(data, size, 12, b'data', '<I', True) or [(0, size)]
+    start = id3v2End(data, size)
+    if data[start:start + 4] == b'fLaC':
+        start = flacAudioStart(data, size, start + 4)
+    end = trailingTagsStart(data, start, size)
+    return [(start, end)] if start < end else [(0, size)]
+
+# skip any ID3v2 tags at the start of the file
+def id3v2End(data, size):
+    start = 0
+    while start + 10 <= size and data[start:start + 3] == b'ID3':
+        header = data[start:start + 10]
+        # the tag size is stored in 7 bits per byte
+        tagSize = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f)
+        # a footer doubles the header
+        start += 10 + tagSize + (10 if header[5] & 0x10 else 0)
+    return min(start, size)
+
+# FLAC metadata blocks have a 4 byte header, the first bit of which marks the last block
+def flacAudioStart(data, size, position):
+    while position + 4 <= size:
+        header = data[position]
+        position += 4 + int.from_bytes(data[position + 1:position + 4], 'big')
+        if header & 0x80:
+            break
+    return min(position, size)
+
+# find where the tags appended to the audio start, they can be stacked in any order
+def trailingTagsStart(data, start, size):
+    end = size
+    while True:
+        if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+            end -= 128
+        elif end - start >= 32 and data[end - 32:end - 24] == b'APETAGEX':
+            tagSize, flags = struct.unpack('<I4xI', data[end - 20:end - 8])
+            # the size counts the items and the footer, the header is only there when the flag says so
+            end -= tagSize + (32 if flags & 0x80000000 else 0)
+        elif end - start >= 15 and data[end - 9:end] == b'LYRICS200' and data[end - 15:end - 9].isdigit():
+            end -= int(data[end - 15:end - 9]) + 15
+        else:
+            return max(end, start)
+
+# the payloads of every chunk or atom named name. MP4 atoms and RIFF chunks only differ in the order
+# of the size and the name, the byte order of the size and RIFF's padding to an even length
+def chunkRanges(data, size, position, name, sizeFormat, riff):
+    ranges = []
+    while position + 8 <= size:
+        if riff:
+            kind, (chunkSize,) = data[position:position + 4], struct.unpack(sizeFormat, data[position + 4:position + 8])
+            header, total = 8, 8 + chunkSize + (chunkSize & 1)
+        else:
+            (chunkSize,), kind = struct.unpack(sizeFormat, data[position:position + 4]), data[position + 4:position + 8]
+            header, total = 8, chunkSize
+            # a size of 1 means a 64 bit size follows, and 0 means the atom runs to the end of the file
+            if chunkSize == 1:
+                header, total = 16, struct.unpack('>Q', data[position + 8:position + 16])[0]
+            elif chunkSize == 0:
+                total = size - position
+        if total < header:
+            break
+        if kind == name:
+            ranges.append((position + header, min(position + total, size)))
+        position += total
+    return ranges
@@ -0,0 +1,284 @@
+import os
+import json
+import random
+import hashlib
+import struct
+import time
+from mutagen.id3 import ID3, TIT2, TPE1, TALB
+from matchIndex import normalize
+
+# stand-ins for YTMusic and musicbrainzngs used by benchmark.py
+# they serve synthetic collections built from a seeded generator, so every run sees the same data,
+# and wait latency seconds on every call to mimic a round trip to the real service
+
+# words are made of syllables so titles share letters and trigrams the way real ones do
+onsets = ['', 'b', 'br', 'c', 'ch', 'd', 'dr', 'f', 'g', 'gr', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'pl', 'r', 's', 'sh', 'st', 't', 'th', 'tr', 'v', 'w', 'z']
+syllables = [o + v + c for o in onsets for v in ['a', 'e', 'i', 'o', 'u', 'ai', 'ou', 'ee'] for c in ['', 'n', 'r', 's', 't', 'l', 'nd', 'ck']]
+genres = ['rock', 'hard rock', 'pop', 'dance pop', 'country', 'folk', 'jazz', 'blues', 'soul', 'punk',
+          'metal', 'alternative', 'hip hop', 'electronic', 'classical', 'christmas', 'reggae', 'disco']
+
+def makeWord(rng):
+    return ''.join(rng.choice(syllables) for i in range(rng.randint(1, 3))).capitalize()
+
+def makePhrase(rng, low, high):
+    return ' '.join(makeWord(rng) for i in range(rng.randint(low, high)))
+
+def formatDuration(seconds):
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
+# one song in the shape get_library_songs and search return it
+def makeSong(rng, i, prefix='v'):
+    seconds = rng.randint(90, 420)
+    return {
+        'videoId': f'{prefix}{i:07d}',
+        'title': makePhrase(rng, 1, 4),
+        'artists': [{'name': makePhrase(rng, 1, 2), 'id': f'UC{rng.getrandbits(48):012x}'}],
+        'album': {'name': makePhrase(rng, 1, 3), 'id': f'MPRE{rng.getrandbits(48):012x}'},
+        'duration': formatDuration(seconds),
+        'duration_seconds': seconds,
+        'feedbackTokens': {'add': f'add{prefix}{i}', 'remove': f'remove{prefix}{i}'},
+        'resultType': 'song',
+        # the rest of what ytmusicapi returns for a song, which nothing reads
+        'thumbnails': [{'url': f'https://lh3.googleusercontent.com/{prefix}{i:07d}=w60-h60-l90-rj', 'width': 60, 'height': 60},
+                       {'url': f'https://lh3.googleusercontent.com/{prefix}{i:07d}=w120-h120-l90-rj', 'width': 120, 'height': 120}],
+        'isAvailable': True,
+        'isExplicit': rng.random() < 0.1,
+        'videoType': 'MUSIC_VIDEO_TYPE_ATV',
+        'inLibrary': True,
+        'likeStatus': 'INDIFFERENT',
+    }
+
+# an upload has artist instead of artists and an entityId to delete it by
+def makeUpload(rng, i):
+    song = makeSong(rng, i, 'u')
+    song['artist'] = song.pop('artists')
+    song['entityId'] = f't_po_{i:07d}'
+    del song['feedbackTokens']
+    return song
+
+# a library of size songs, a fifth as many uploads, a tenth of the library liked
+# and half as many songs again that are only found by searching
+def makeCollections(size, seed=1):
+    rng = random.Random(seed)
+    library = [makeSong(rng, i) for i in range(size)]
+    uploads = [makeUpload(rng, i) for i in range(size // 5)]
+    catalog = [makeSong(rng, i, 'c') for i in range(size // 2)]
+    likes = {'id': 'LM', 'title': 'Liked Music', 'privacy': 'PRIVATE', 'trackCount': size // 10,
+             'tracks': rng.sample(library, size // 10)}
+    return library, uploads, likes, catalog
+
+# MusicBrainz data for a collection, in the shape fillMBdata stores it
+def makeMBdata(songs, seed=1):
+    rng = random.Random(seed)
+    MBdata = {}
+    for song in songs:
+        tags = rng.sample(genres, rng.randint(0, 3))
+        MBdata[song['videoId']] = {'duration': song['duration_seconds'] * 1000, 'year': rng.choice([None] + list(range(1960, 2024))),
+                                   'genres': tags, 'mbID': f'mb-{song["videoId"]}'}
+    return MBdata
+
+def sleep(latency):
+    if latency:
+        time.sleep(latency)
+
+class FakeYTMusic:
+    def __init__(self, library, uploads, likes, catalog, latency=0.0):
+        self.library = library
+        self.uploads = uploads
+        self.likes = likes
+        self.latency = latency
+        self.calls = {}
+        self.playlists = {}
+        # search answers by normalized title, catalog songs first so library songs are found as well
+        self.byTitle = {}
+        for song in catalog + library:
+            self.byTitle.setdefault(normalize(song['title']), []).append(song)
+
+    # list calls come back in pages of 100 songs, each one a round trip
+    def call(self, name, songs=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        sleep(self.latency * max(1, -(-songs // 100)))
+
+    def get_library_upload_songs(self, limit=25, order=None):
+        self.call('get_library_upload_songs', min(limit, len(self.uploads)))
+        return self.uploads[:limit]
+
+    def get_library_songs(self, limit=25, validate_responses=False, order=None):
+        self.call('get_library_songs', min(limit, len(self.library)))
+        return self.library[:limit]
+
+    def get_liked_songs(self, limit=100):
+        self.call('get_liked_songs', min(limit, len(self.likes['tracks'])))
+        return dict(self.likes, tracks=self.likes['tracks'][:limit])
+
+    def get_library_playlists(self, limit=25):
+        self.call('get_library_playlists')
+        return [{'playlistId': pid, 'title': p['title'], 'count': str(len(p['tracks']))} for pid, p in self.playlists.items()][:limit]
+
+    # the query is "artist - title" as searchYT builds it
+    def search(self, query, filter=None, scope=None, limit=20, ignore_spelling=False):
+        self.call('search')
+        title = query.split(' - ', 1)[-1]
+        return self.byTitle.get(normalize(title), [])[:limit]
+
+    def edit_song_library_status(self, feedbackTokens=None):
+        self.call('edit_song_library_status')
+        return {'feedbackResponses': [{'isProcessed': True}]}
+
+    def rate_song(self, videoId, rating='INDIFFERENT'):
+        self.call('rate_song')
+        return {}
+
+    def create_playlist(self, title, description, privacy_status='PRIVATE', video_ids=None, source_playlist=None):
+        self.call('create_playlist')
+        pid = f'PL{len(self.playlists):06d}'
+        self.playlists[pid] = {'title': title, 'tracks': []}
+        return pid
+
+    def get_playlist(self, playlistId, limit=100, related=False, suggestions_limit=0):
+        self.call('get_playlist')
+        tracks = self.playlists[playlistId]['tracks']
+        return {'id': playlistId, 'trackCount': len(tracks), 'tracks': tracks[:limit]}
+
+    def add_playlist_items(self, playlistId, videoIds=None, source_playlist=None, duplicates=False):
+        self.call('add_playlist_items')
+        tracks = self.playlists[playlistId]['tracks']
+        added = [{'videoId': v, 'setVideoId': f'set{playlistId}{len(tracks) + i}'} for i, v in enumerate(videoIds)]
+        tracks += added
+        return {'status': 'STATUS_SUCCEEDED', 'playlistEditResults': added}
+
+    def remove_playlist_items(self, playlistId, videos):
+        self.call('remove_playlist_items')
+        removed = {v['setVideoId'] for v in videos}
+        self.playlists[playlistId]['tracks'] = [t for t in self.playlists[playlistId]['tracks'] if t['setVideoId'] not in removed]
+        return 'STATUS_SUCCEEDED'
+
+    def upload_song(self, filepath):
+        self.call('upload_song')
+        return 'STATUS_SUCCEEDED'
+
+# the musicbrainzngs calls getMBinfo and the oldest date plugin make
+# install() swaps them into the musicbrainzngs module and returns what has to be put back
+class FakeMusicBrainz:
+    names = ['search_recordings', 'get_recording_by_id', 'get_work_by_id']
+
+    def __init__(self, songs, latency=0.0, seed=1):
+        self.latency = latency
+        self.calls = {}
+        rng = random.Random(seed)
+        self.byTitle = {}
+        self.recordings = {}
+        self.works = {}
+        for i, song in enumerate(songs):
+            artist = song.get('artists') or song.get('artist')
+            recordingId = f'rec-{song["videoId"]}'
+            workId = f'work-{i // 3}'
+            credit = [{'artist': {'id': artist[0]['id'] if 'id' in artist[0] else artist[0]['name'], 'name': artist[0]['name']}, 'name': artist[0]['name']}]
+            recording = {'id': recordingId, 'title': song['title'], 'length': str(song['duration_seconds'] * 1000), 'artist-credit': credit,
+                         'release-list': [{'id': f'rel-{i}', 'title': song['album']['name'], 'status': 'Official', 'date': f'{rng.randint(1960, 2023)}-01-01'}],
+                         'work-relation-list': [{'type': 'performance', 'work': {'id': workId}}]}
+            if rng.random() < 0.7:
+                recording['tag-list'] = [{'name': g, 'count': '1'} for g in rng.sample(genres, rng.randint(1, 3))]
+            self.recordings[recordingId] = recording
+            self.works.setdefault(workId, {'id': workId, 'recording-relation-list': []})['recording-relation-list'].append(
+                {'type': 'performance', 'recording': {'id': recordingId}, 'begin': f'{rng.randint(1950, 2023)}'})
+            self.byTitle.setdefault(normalize(song['title']), []).append(recording)
+
+    # list calls come back in pages of 100 songs, each one a round trip
+    def call(self, name, songs=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        sleep(self.latency * max(1, -(-songs // 100)))
+
+    def search_recordings(self, query='', limit=None, offset=None, strict=False, **fields):
+        self.call('search_recordings')
+        return {'recording-list': self.byTitle.get(normalize(fields.get('recording', '')), [])[:limit]}
+
+    def get_recording_by_id(self, id, includes=[], release_status=[], release_type=[]):
+        self.call('get_recording_by_id')
+        return {'recording': self.recordings[id]}
+
+    def get_work_by_id(self, id, includes=[]):
+        self.call('get_work_by_id')
+        return {'work': self.works[id]}
+
+    def install(self, module):
+        saved = {name: getattr(module, name) for name in self.names}
+        for name in self.names:
+            setattr(module, name, getattr(self, name))
+        return saved
+
+    @staticmethod
+    def restore(module, saved):
+        for name, func in saved.items():
+            setattr(module, name, func)
+
+# a frame header for MPEG 1 layer 3 at 128 kbps and 44.1 kHz, every frame is 417 bytes
+frameHeader = b'\xff\xfb\x90\x64'
+
+# the smallest mp3 that tag readers accept: a Xing frame that claims the right number of frames
+# followed by a few almost empty ones, so the length comes out right without storing any audio.
+# the frames carry a digest of the song, so files of different songs never have the same audio
+def writeMp3(filename, title, artist, album, seconds):
+    frames = int(seconds * 44100 / 1152)
+    first = frameHeader + bytes(32) + b'Xing' + struct.pack('>II', 1, frames)
+    audio = hashlib.sha1(f'{artist}/{title}/{seconds}'.encode('utf-8')).digest()
+    with open(filename, 'wb') as f:
+        f.write(first + bytes(417 - len(first)) + (frameHeader + audio + bytes(413 - len(audio))) * 3)
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=artist))
+    tags.add(TALB(encoding=3, text=album))
+    tags.save(filename)
+
+# write count tagged files under root, in album folders like a real music collection
+# half of them are already in the library, a quarter are found by searching and the rest are missing.
+# every eighth file is a copy of the one before it on a compilation, with the same audio and other tags
+def writeTagTree(root, count, library, catalog, seed=1):
+    rng = random.Random(seed)
+    for i in range(count):
+        kind = i % 4
+        if i % 8 == 7:
+            artist = song['artists'][0]['name']
+            folder = os.path.join(root, 'Compilations', f'Best Of {i // 8}')
+            os.makedirs(folder, exist_ok=True)
+            writeMp3(os.path.join(folder, f'{i:05d} {artist} - {song["title"]}.mp3'), song['title'], artist, f'Best Of {i // 8}', song['duration_seconds'])
+            continue
+        if kind < 2:
+            song = rng.choice(library)
+        elif kind == 2:
+            song = rng.choice(catalog)
+        else:
+            song = makeSong(rng, i, 'm')
+        artist = song['artists'][0]['name']
+        folder = os.path.join(root, artist, song['album']['name'])
+        os.makedirs(folder, exist_ok=True)
+        writeMp3(os.path.join(folder, f'{i:05d} {song["title"]}.mp3'), song['title'], artist, song['album']['name'], song['duration_seconds'])
+
+# write count playlists of length files each, picked from the tagged files under root so many playlists share files
+# entries are relative to the playlist folder, and every third playlist is a PLS file
+def writePlaylists(folder, root, count, length, seed=1):
+    rng = random.Random(seed)
+    files = sorted(os.path.join(dirName, filename) for dirName, subdirList, fileList in os.walk(root) for filename in fileList)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        entries = [os.path.relpath(f, folder) for f in rng.sample(files, min(length, len(files)))]
+        if i % 3 == 2:
+            lines = ['[playlist]'] + [f'File{n + 1}={entry}' for n, entry in enumerate(entries)] + [f'NumberOfEntries={len(entries)}', 'Version=2']
+            name = f'list{i:03d}.pls'
+        else:
+            lines = ['#EXTM3U'] + [line for entry in entries for line in (f'#EXTINF:-1,{os.path.basename(entry)}', entry)]
+            name = f'list{i:03d}.m3u8'
+        with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+# a MusicBrainz JSON dump with one recording for every song, one per line as in mbdump/recording
+def writeMBdump(filename, songs, seed=1):
+    rng = random.Random(seed)
+    with open(filename, 'w', encoding='utf-8') as f:
+        for song in songs:
+            artist = song.get('artists') or song.get('artist')
+            recording = {'id': f'rec-{song["videoId"]}', 'title': song['title'], 'length': song['duration_seconds'] * 1000,
+                         'artist-credit': [{'name': artist[0]['name'], 'joinphrase': '', 'artist': {'id': artist[0].get('id'), 'name': artist[0]['name']}}],
+                         'first-release-date': f'{rng.randint(1960, 2023)}-01-01', 'video': False,
+                         'tags': [{'name': g, 'count': 1} for g in rng.sample(genres, rng.randint(0, 3))]}
+            f.write(json.dumps(recording) + '\n')
@@ -0,0 +1,260 @@
+#!/usr/local/bin/python3
+
+# offline benchmarks for the hot paths of ytmusic-sync
+# YT Music and MusicBrainz are replaced by the stand-ins in benchFakes, so nothing touches the network
+# usage: benchmark.py [--sizes 10000,100000,500000] [--latency seconds] [--save | --compare]
+
+import sys
+import os
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import configparser
+import importlib.util
+import musicbrainzngs
+
+from benchFakes import makeCollections, makeMBdata, FakeYTMusic, FakeMusicBrainz, writeTagTree, writePlaylists, writeMBdump
+from fileOperations import loadCache, fillMBdata
+from matchIndex import buildIndex, candidates
+from mbIndex import importDumps, openMBindex
+from mbCache import configureMBcache
+from rateLimiter import configureLimiter
+from scoring import configureScoring, loadBackend
+from songRecord import buildRecords
+from stateStore import openStore, putMBinfo, commitStore
+from utils import filterSongs, performQuery
+
+baselineFile = 'benchmark-baseline.json'
+smartRules = {
+    'Oldies': {'year': '1960-1979'},
+    'Rock': {'genre': json.dumps(['rock', '^punk', '^metal'])},
+    '90s Pop': {'year': '1990-1999', 'genre': json.dumps(['pop'])},
+    '2001': {'year': '2001'},
+}
+# the main script has a dash in its name, so it is loaded from its path
+def loadSyncModule():
+    spec = importlib.util.spec_from_file_location('ytmusicSync', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytmusic-sync.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# the defaults loadConfig writes for a new user, plus a few smart playlists
+def benchConfig():
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'wordRatio': '96', 'phraseRatio': '89', 'YTDelay': '0', 'mbhost': 'musicbrainz.org', 'mbrateLimit': '1',
+                         'approach': 'hybrid', 'ignoredartists': json.dumps(['karaoke', 'in the style of', 'tribute']),
+                         'ignoredphrases': json.dumps(['karaoke', 'in the style of', 'tribute']), 'mbcheckpoint': '100'}
+    for name, rule in smartRules.items():
+        config[name] = rule
+    return config
+
+# stats for one stage: total time, throughput and per call latency in milliseconds
+def stageStats(items, seconds, timings):
+    timings = sorted(timings)
+    percentile = lambda p: round(timings[min(len(timings) - 1, int(p * len(timings)))] * 1000, 3) if timings else None
+    return {'items': items, 'seconds': round(seconds, 4), 'perSecond': round(items / seconds, 1) if seconds else None,
+            'p50': percentile(0.5), 'p95': percentile(0.95)}
+
+# call func once per argument and time every call
+def timeCalls(func, argList, items=None):
+    timings = []
+    start = time.perf_counter()
+    for args in argList:
+        callStart = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - callStart)
+    return stageStats(items or len(timings), time.perf_counter() - start, timings)
+
+# the stages only print progress, which would swamp the report
+@contextlib.contextmanager
+def quiet():
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+        yield
+
+def runSize(size, args, sync, workDir):
+    results = {}
+    config = benchConfig()
+    library, uploads, likes, catalog = makeCollections(size, args.seed)
+    ytmusic = FakeYTMusic(library, uploads, likes, catalog, args.latency)
+    sample = library[::max(1, size // args.queries)][:args.queries] + catalog[::max(1, len(catalog) // args.queries)][:args.queries]
+    wordRatio = config['DEFAULT'].getint('wordRatio')
+    phraseRatio = config['DEFAULT'].getint('phraseRatio')
+    checks = lambda song: [('title', song['title'], phraseRatio), ('artists', song['artists'][0]['name'], wordRatio if ' ' not in song['artists'][0]['name'] else phraseRatio)]
+
+    with quiet():
+        # first run downloads every collection, the second only the newest songs
+        conn = openStore(os.path.join(workDir, f'state{size}.db'))
+        results['loadCache full'] = timeCalls(lambda: loadCache(ytmusic, conn, None, True), [()], len(library) + len(uploads) + len(likes['tracks']))
+        results['loadCache delta'] = timeCalls(lambda: loadCache(ytmusic, conn, None), [()], len(library) + len(uploads) + len(likes['tracks']))
+
+        results['buildRecords'] = timeCalls(buildRecords, [(library,)], len(library))
+        library = buildRecords(library)
+        uploads = buildRecords(uploads)
+        likes = dict(likes, tracks=buildRecords(likes['tracks']))
+        index = buildIndex(library)
+        results['buildIndex'] = timeCalls(buildIndex, [(library,)], len(library))
+        results['filterSongs'] = timeCalls(lambda song: filterSongs(candidates(index, library, song['title']), checks(song), 'title', True, True), [(s,) for s in sample])
+        results['performQuery'] = timeCalls(lambda song: performQuery(config, song['title'].split(' '), library, False), [(s,) for s in sample[:args.fullScans]])
+
+        # every song already has MusicBrainz data, so this measures rule evaluation and playlist syncing
+        MBdata = makeMBdata(library + uploads, args.seed)
+        for videoId, info in MBdata.items():
+            putMBinfo(conn, videoId, info)
+        commitStore(conn)
+        setGlobals(sync, config, ytmusic, conn, library, uploads, likes, args.workers)
+        results['smartPlaylists new'] = timeCalls(sync.smartPlaylists, [()], len(library) + len(uploads))
+        results['smartPlaylists unchanged'] = timeCalls(sync.smartPlaylists, [()], len(library) + len(uploads))
+        # a fuzzy artist term narrowed by year and genre lookups, the field indexes are built by the first query
+        structured = lambda song: performQuery(config, [f'artist:{song["artists"][0]["name"]}', 'year:1960-2020', 'NOT', 'genre:jazz'], library, False, MBdata)
+        results['performQuery structured'] = timeCalls(structured, [(s,) for s in sample[:args.fullScans * 4] if s.get('artists')])
+
+        # look up songs nobody has looked up yet, each one a search, a recording and a work
+        mbConn = openStore(os.path.join(workDir, f'mb{size}.db'))
+        mbSongs = library[:args.mbSongs]
+        fake = FakeMusicBrainz(mbSongs, args.latency, args.seed)
+        saved = fake.install(musicbrainzngs)
+        configureMBcache(mbConn)
+        try:
+            results['fillMBdata'] = timeCalls(lambda: fillMBdata(mbConn, config, [('library', mbSongs)]), [()], len(mbSongs))
+            cold = dict(fake.calls)
+            fake.calls.clear()
+            # look the same songs up again with the recordings and works already cached
+            mbConn.execute('DELETE FROM mbdata')
+            results['fillMBdata cached'] = timeCalls(lambda: fillMBdata(mbConn, config, [('library', mbSongs)]), [()], len(mbSongs))
+            results['mbCalls'] = {'cold': cold, 'cached': dict(fake.calls)}
+        finally:
+            FakeMusicBrainz.restore(musicbrainzngs, saved)
+            configureMBcache(None)
+        mbConn.close()
+
+        # import a dump of every library song, then look songs up in it without the web service
+        dump = os.path.join(workDir, f'recording{size}.json')
+        writeMBdump(dump, library, args.seed)
+        indexFile = os.path.join(workDir, f'mbindex{size}.db')
+        results['mbimport'] = timeCalls(importDumps, [(indexFile, [dump])], len(library))
+        mbIndex = openMBindex(indexFile)
+        mbConn = openStore(os.path.join(workDir, f'mbIndexed{size}.db'))
+        indexSongs = library[:args.mbIndexSongs]
+        results['fillMBdata index'] = timeCalls(lambda: fillMBdata(mbConn, config, [('library', indexSongs)], mbIndex), [()], len(indexSongs))
+        mbConn.close()
+        mbIndex.close()
+
+        # scan a tree of tagged files, then scan it again when the manifest resolves every file
+        tree = os.path.join(workDir, f'tree{size}')
+        writeTagTree(tree, args.files, library, catalog, args.seed)
+        setGlobals(sync, config, ytmusic, conn, library, uploads, likes, args.workers)
+        results['processFile'] = timeCalls(sync.loadDir, [(tree,)], args.files)
+        results['processFile manifest'] = timeCalls(sync.loadDir, [(tree,)], args.files)
+
+        # import many playlists that share the same files, starting from an empty manifest
+        lists = os.path.join(workDir, f'lists{size}')
+        writePlaylists(lists, tree, args.playlists, args.playlistLength, args.seed)
+        setGlobals(sync, config, ytmusic, conn, library, uploads, likes, args.workers)
+        results['loadPlaylist'] = timeCalls(sync.loadPlaylist, [([lists],)], args.playlists * min(args.playlistLength, args.files))
+        conn.close()
+    results['calls'] = ytmusic.calls
+    return results
+
+# the module globals the main block would set up after loadConfig and loadCache
+def setGlobals(sync, config, ytmusic, conn, library, uploads, likes, workers):
+    sync.config = config
+    sync.ytmusic = ytmusic
+    sync.conn = conn
+    sync.library = library
+    sync.uploads = uploads
+    sync.likes = likes
+    sync.playlists = ytmusic.get_library_playlists(500)
+    sync.libraryIndex = buildIndex(library)
+    sync.uploadsIndex = buildIndex(uploads)
+    sync.knownIds = {s['videoId'] for s in library + uploads + likes['tracks'] if s.get('videoId')}
+    sync.wordRatio = config['DEFAULT'].getint('wordRatio')
+    sync.phraseRatio = config['DEFAULT'].getint('phraseRatio')
+    sync.ignoredArtists = json.loads(config['DEFAULT']['ignoredartists'])
+    sync.ignoredPhrases = json.loads(config['DEFAULT']['ignoredphrases'])
+    sync.scanWorkers = workers or os.cpu_count()
+    sync.uploadSongs = False
+    sync.notFound = {}
+    sync.searchCache = {'hits': {}, 'misses': {}}
+    sync.manifest = {}
+    sync.resolvedFiles = {}
+
+def printResults(size, results):
+    print(f'\n{size} songs')
+    print(f'  {"stage":<26}{"items":>9}{"seconds":>11}{"items/s":>12}{"p50 ms":>10}{"p95 ms":>10}')
+    for stage, stats in results.items():
+        if stage in ('calls', 'mbCalls'):
+            continue
+        print(f'  {stage:<26}{stats["items"]:>9}{stats["seconds"]:>11}{stats["perSecond"] or "-":>12}{stats["p50"] or "-":>10}{stats["p95"] or "-":>10}')
+    print('  calls: ' + ', '.join(f'{name} {count}' for name, count in sorted(results['calls'].items())))
+    for run, calls in results.get('mbCalls', {}).items():
+        print(f'  musicbrainz calls {run}: ' + ', '.join(f'{name} {count}' for name, count in sorted(calls.items())))
+
+# compare throughput against the baseline and return the stages that got slower than tolerance allows
+def compareResults(report, baseline, tolerance):
+    regressions = []
+    for size, results in report['sizes'].items():
+        for stage, stats in results.items():
+            old = baseline.get('sizes', {}).get(size, {}).get(stage)
+            if stage in ('calls', 'mbCalls') or not old or not old.get('perSecond') or not stats.get('perSecond'):
+                continue
+            ratio = stats['perSecond'] / old['perSecond']
+            flag = 'REGRESSION' if ratio < 1 - tolerance else ''
+            print(f'  {size:>7} {stage:<26}{old["perSecond"]:>12}{stats["perSecond"]:>12}{ratio:>8.2f}x {flag}')
+            if flag:
+                regressions.append((size, stage))
+    return regressions
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for ytmusic-sync')
+    parser.add_argument('--sizes', default='10000', help='comma separated library sizes, e.g. 10000,100000,500000')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every fake YT Music and MusicBrainz call waits')
+    parser.add_argument('--files', type=int, default=200, help='number of tagged files to scan')
+    parser.add_argument('--queries', type=int, default=50, help='number of titles to match against the library')
+    parser.add_argument('--fullScans', type=int, default=5, help='number of queries to run through performQuery')
+    parser.add_argument('--playlists', type=int, default=30, help='number of playlist files to import')
+    parser.add_argument('--playlistLength', type=int, default=25, help='number of files in each playlist')
+    parser.add_argument('--mbSongs', type=int, default=200, help='number of songs to look up in MusicBrainz')
+    parser.add_argument('--mbIndexSongs', type=int, default=2000, help='number of songs to look up in the offline MusicBrainz index')
+    parser.add_argument('--workers', type=int, default=0, help='tag reader processes, 0 for one per CPU')
+    parser.add_argument('--backend', default='auto', help='fuzzy scoring backend: auto, rapidfuzz or fuzzywuzzy')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=baselineFile, help='file baseline results are saved to and compared against')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare against the baseline and exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed drop in throughput before a stage counts as a regression')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    configureLimiter(0, 4)
+    configureScoring(args.backend)
+    sync = loadSyncModule()
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'backend': loadBackend(),
+              'latency': args.latency, 'files': args.files, 'sizes': {}}
+    with tempfile.TemporaryDirectory() as workDir:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            report['sizes'][str(size)] = runSize(size, args, sync, workDir)
+            printResults(size, report['sizes'][str(size)])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nSaved baseline to {args.baseline}')
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f'\nNo baseline at {args.baseline}, run with --save first')
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'\nCompared to {args.baseline} (items/s)')
+        if compareResults(report, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,12 +1,18 @@
 import os, subprocess, platform
-from ytmusicapi import YTMusic
 import pathlib
 import pickle
 import csv
-from tqdm import tqdm
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
 from utils import *
+from stateStore import *
+from metrics import count, stage, observe
+from rateLimiter import limitedCall, runBounded, httpStatus
+from audioHash import audioHash
+from matchIndex import normalize
 
 def editConfig(configPath):
     if platform.system() == 'Darwin':       # macOS
@@ -16,76 +22,241 @@ def editConfig(configPath):
     else:                                   # linux variants
         subprocess.call(('xdg-open', configPath))
 
-# save the cachefile if there were no changes made
-def saveCache(cacheFile, MBfile, MBdata, cache):
-    if MBdata:
-        with openFile(MBfile,'wb') as (f, err):
+# load uploads, library, playlists and likes from the database and then bring them up to date
+# only the newest songs are downloaded unless a full reconciliation is due, which also catches removals.
+# the collections are downloaded at once on the shared rate limit, each with a progress bar counting its pages
+# fullSync: force a full download of every collection
+# names: the collections a command reads, the others are neither loaded nor downloaded and come back empty
+# ytmusic: None only loads what the database has, for commands that only read the collections
+def loadCache(ytmusic, conn, authFile, fullSync=False, fullSyncDays=7, names=('uploads', 'library', 'playlists', 'likes')):
+    print(f'Loading {", ".join(names)} from database')
+    with stage('cache_load'):
+        cached = {
+            'uploads': loadCollection(conn, 'uploads') if 'uploads' in names else [],
+            'library': loadCollection(conn, 'library') if 'library' in names else [],
+            'playlists': [],
+            'likes': loadLikes(conn) if 'likes' in names else None
+        }
+    if ytmusic is None:
+        return cached['uploads'] or [], cached['library'] or [], [], cached['likes'] or {'tracks': []}
+    from tqdm import tqdm
+    loaders = {
+        'uploads': lambda: syncCollection(conn, 'uploads', cached['uploads'], lambda limit: limitedCall(ytmusic.get_library_upload_songs, limit, 'recently_added'), fullSync, fullSyncDays),
+        'library': lambda: syncCollection(conn, 'library', cached['library'], lambda limit: limitedCall(ytmusic.get_library_songs, limit, True, 'recently_added'), fullSync, fullSyncDays),
+        'playlists': lambda: syncPlaylists(conn, ytmusic),
+        'likes': lambda: syncLikes(conn, ytmusic, cached['likes'], fullSync, fullSyncDays)
+    }
+    session = getattr(ytmusic, '_session', None)
+    if session is not None and hasattr(session, 'hooks') and countPage not in session.hooks['response']:
+        session.hooks['response'].append(countPage)
+    bars = {name: tqdm(desc=f'{name:>9}', unit=' pages', position=i, leave=True) for i, name in enumerate(names)}
+
+    def load(name):
+        loading.bar = bars[name]
+        try:
+            with stage(f'sync_{name}'):
+                return loaders[name]()
+        finally:
+            loading.bar = None
+
+    loaded = dict(cached)
+    try:
+        for (name,), result in runBounded(load, [(name,) for name in names]):
+            loaded[name] = result
+            items = (result or {}).get('tracks', []) if name == 'likes' else result
+            bars[name].set_postfix(items=len(items))
+            bars[name].close()
+    except Exception as err:
+        for bar in bars.values():
+            bar.close()
+        # only a refused login means the headers expired, database and server errors are raised as they are
+        if httpStatus(err) not in (401, 403):
+            raise
+        if authFile and os.path.exists(authFile):
+            os.remove(authFile)
+        print('Authorization expired. Next run will require pasted headers.')
+        exit(1)
+    return loaded['uploads'], loaded['library'], loaded['playlists'], loaded['likes'] or {'tracks': []}
+
+# the progress bar of the collection a loader thread is downloading, see countPage
+loading = threading.local()
+
+# a response hook for the YTMusic session, every page a loader thread gets moves its collection's progress bar
+def countPage(response, *args, **kwargs):
+    bar = getattr(loading, 'bar', None)
+    if bar is not None:
+        bar.update(1)
+
+def syncPlaylists(conn, ytmusic):
+    playlists = limitedCall(ytmusic.get_library_playlists, 500)
+    savePlaylists(conn, playlists)
+    return playlists
+
+# the liked songs playlist reports its size, so a delta that does not add up gets a full download
+def syncLikes(conn, ytmusic, likes, fullSync, fullSyncDays):
+    likesResponse = {}
+
+    def fetchLikes(limit):
+        likesResponse.update(limitedCall(ytmusic.get_liked_songs, limit))
+        return likesResponse['tracks']
+
+    tracks = syncCollection(conn, 'likes', likes['tracks'] if likes else None, fetchLikes, fullSync, fullSyncDays)
+    if likes and likesResponse.get('trackCount') is not None and likes.get('trackCount') is not None:
+        expected = likes['trackCount'] + len(tracks) - len(likes['tracks'])
+        if likesResponse['trackCount'] != expected:
+            tracks = syncCollection(conn, 'likes', tracks, fetchLikes, True, fullSyncDays)
+    if likesResponse:
+        likes = dict(likesResponse, tracks=tracks)
+        saveLikes(conn, likes)
+    return likes
+
+# bring one collection up to date and save it if anything changed
+# fetch(limit) returns the newest limit songs of the collection
+def syncCollection(conn, name, cached, fetch, fullSync, fullSyncDays):
+    from tqdm import tqdm
+    if cached is None or fullSync or time.time() - getMeta(conn, f'fullsync:{name}', 0) > fullSyncDays * 86400:
+        tqdm.write(f'getting all {name} songs from YT music')
+        songs = fetch(100000)
+        saveCollection(conn, name, songs)
+        setMeta(conn, f'fullsync:{name}', time.time())
+        return songs
+    songs = deltaFetch(fetch, cached)
+    if [songKey(s, i) for i, s in enumerate(songs)] != [songKey(s, i) for i, s in enumerate(cached)]:
+        tqdm.write(f'updated {name} songs from YT music')
+        saveCollection(conn, name, songs)
+    return songs
+
+# page from the newest song until the results reach one that is already cached, then put the new
+# songs in front of the cached ones. cached songs newer than that point that are gone were removed.
+# the API only pages from the newest song, so every step downloads the songs of the step before again
+# (25, 100, 400, ...), which is still far less than the whole collection when only a few songs were added
+def deltaFetch(fetch, cached):
+    positions = {songKey(s, i): i for i, s in enumerate(cached)}
+    limit = 25
+    while True:
+        fetched = fetch(limit)
+        # the whole collection came back
+        if len(fetched) < limit:
+            return fetched
+        last = songKey(fetched[-1], -1)
+        if last in positions:
+            # a song that was moved, or removed and added again, is in the new songs and not where it was cached
+            # songs without a videoId or entityId only have a position key, so they never match
+            seen = {songKey(s, -1) for s in fetched}
+            return fetched + [s for i, s in enumerate(cached[positions[last] + 1:], positions[last] + 1) if songKey(s, i) not in seen]
+        limit *= 4
+
+# read the tags needed for matching, and the hash of the audio, from one file
+# returns the filename and a small record, or None for damaged and non-audio files
+def readTags(filename):
+    # phrydy is only imported by commands that read tags, and once per tag reader process
+    from phrydy import MediaFileExtended
+    try:
+        track = MediaFileExtended(filename)
+    except Exception:
+        return filename, None
+    if not track:
+        return filename, None
+    # copies of the same recording are matched once, see processUnique
+    try:
+        fileHash = audioHash(filename)
+    except (OSError, ValueError):
+        fileHash = None
+    return filename, {'artist': track.artist, 'title': track.title, 'album': track.album, 'length': track.length, 'audioHash': fileHash}
+
+# readTags for the process pool, which also returns how long it took so the time can be recorded here
+def readTagsTimed(filename):
+    start = time.perf_counter()
+    return readTags(filename), time.perf_counter() - start
+
+# read tags for a stream of files with a pool of processes and yield them as they finish
+# at most window files are waiting at once so a huge tree is never queued up in memory
+def readTagsParallel(paths, workers, window=None):
+    if workers <= 1:
+        for filename in paths:
+            with stage('tags'):
+                result = readTags(filename)
+            yield result
+        return
+    window = window or workers * 4
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for filename in paths:
+            pending.add(pool.submit(readTagsTimed, filename))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield tagsResult(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield tagsResult(future)
+
+def tagsResult(future):
+    result, seconds = future.result()
+    observe('stage_seconds', seconds, stage='tags')
+    return result
+
+# load the scan manifest that remembers how each local file was resolved
+def loadManifest(manifestFile):
+    if manifestFile.exists():
+        with openFile(manifestFile, 'rb') as (f, err):
             if err:
-                print(f'Problem writing MB cache file: {err}')
+                print(f'Problem loading scan manifest: {err}')
             else:
-                pickle.dump(MBdata, f)
-    if cache:
-        with openFile(cacheFile,'wb') as (f, err):
+                manifest = pickle.load(f)
+                print(f'Loaded {len(manifest)} files from scan manifest')
+                return manifest
+    return {}
+
+def saveManifest(manifestFile, manifest):
+    if manifest:
+        with openFile(manifestFile, 'wb') as (f, err):
             if err:
-                print(f'Problem writing cache file: {err}')
+                print(f'Problem writing scan manifest: {err}')
             else:
-                pickle.dump(cache, f)
-                print('saved cache file')
-    # with openFile('library.csv','w') as (f, err):
-    #     missing = csv.DictWriter(f, fieldnames=cache[1][0].keys())
-    #     missing.writeheader()
-    #
-    #     for song in cache[1]:
-    #         missing.writerow(song)
-
-# load the cachefile if it exists and then check to make sure cache is not outdated
-# otherwise just load the library, uploads, playlists, and liked songs from YT music
-def loadCache(ytmusic, cacheFile):
-    uploads = None
-    library = None
-    playlists = None
-    likes = None
-    if cacheFile.exists():
-        print('Loading uploads and library from cache file')
-        with openFile(cacheFile, 'rb') as (f, err):
+                pickle.dump(manifest, f)
+
+# load the cache of raw search responses used by searchYT
+def loadSearchCache(searchFile):
+    if searchFile.exists():
+        with openFile(searchFile, 'rb') as (f, err):
             if err:
-                print(f'Problem loading cache: {err}')
+                print(f'Problem loading search cache: {err}')
             else:
-                uploads, library, playlists, likes = pickle.load(f)
-    try:
-        check = ytmusic.get_library_upload_songs(1, 'recently_added')
-        if not uploads or check[0]['videoId'] != uploads[0]['videoId']:
-            print('getting uploaded songs from YT music')
-            uploads = ytmusic.get_library_upload_songs(100000, 'recently_added')
-        check = ytmusic.get_library_songs(1, True, 'recently_added')
-        if not library or check[0]['videoId'] != library[0]['videoId']:
-            print('getting library songs from YT music')
-            library = ytmusic.get_library_songs(100000, True, 'recently_added')
-        print('getting library playlists from YT music')
-        playlists = ytmusic.get_library_playlists(500)
-        check = ytmusic.get_liked_songs(1)
-        if not likes or check['trackCount'] != likes['trackCount']:
-            print('getting liked songs from YT music')
-            likes = ytmusic.get_liked_songs(100000)
-    except Exception:
-        os.remove(authFile)
-        print('Authorization expired. Next run will require pasted headers.')
-        exit(1)
-    saveCache(cacheFile, None, None, [uploads, library, playlists, likes])
-    return uploads, library, playlists, likes
+                cache = pickle.load(f)
+                print(f'Loaded {len(cache["hits"]) + len(cache["misses"])} searches from search cache')
+                return cache
+    return {'hits': {}, 'misses': {}}
 
-def fillMBdata(cacheFile, config, MBfile, collections):
-
-    MBdata = None
-    if MBfile.exists():
-        with openFile(MBfile,'rb') as (f, err):
+def saveSearchCache(searchFile, cache):
+    if cache and (cache['hits'] or cache['misses']):
+        # copy first since search threads may still be adding entries
+        snapshot = {'hits': dict(cache['hits']), 'misses': dict(cache['misses'])}
+        with openFile(searchFile, 'wb') as (f, err):
             if err:
-                print(f'Problem loading data from MB cache file: {err}')
+                print(f'Problem writing search cache: {err}')
             else:
-                MBdata = pickle.load(f)
-                MBdata = convertMBdata(MBdata)
-                print(f'Loaded {len(MBdata)} entries from MusicBrainz cache file')
+                pickle.dump(snapshot, f)
+
+# look up the songs MusicBrainz has not been asked about yet
+# mbIndex: the offline index from openMBindex, or None to only use the web service
+def fillMBdata(conn, config, collections, mbIndex=None):
+    from tqdm import tqdm
+    retryAfter = config['DEFAULT'].getfloat('mbretrydays', 30) * 86400
+    checkpointSongs = config['DEFAULT'].getint('mbcheckpoint', 100)
+    checkpointSeconds = config['DEFAULT'].getfloat('mbcheckpointseconds', 300)
+
+    MBdata = loadMBdata(conn)
+    print(f'Loaded {len(MBdata)} entries from MusicBrainz cache')
+    misses = loadMBmisses(conn)
+    # the same song is often in uploads, library and likes under different videoIds, so it is looked up once
+    lookups = {}
+    unsaved = 0
+    lastSave = time.time()
     for name, songList in collections:
+        if not songList:
+            continue
         # uploads has a different tag for artist
         artist = 'artist' if 'artist' in songList[0].keys() else 'artists'
         print(f' Getting MB data for songs in {name}')
@@ -93,16 +264,37 @@ def fillMBdata(cacheFile, config, MBfile, collections):
             # skip songs already pulled from MusicBrainz
             if song['videoId'] in MBdata:
                 continue
+            # skip songs MusicBrainz did not know about until it is time to try again
+            if misses.get(song['videoId'], 0) > time.time():
+                continue
             # if 'duration' in song:
             #     t = datetime.strptime(song['duration'], '%M:%S')
             #     durationDelta = timedelta(minutes=t.minute, seconds=t.second)
             #     duration = int(durationDelta.total_seconds() * 1000)
             # else:
             #     duration = 0
-            songInfo = getMBinfo(config, song['title'], song[artist][0]['name'])
+            key = (normalize(song['title']), normalize(song[artist][0]['name']))
+            if key in lookups:
+                songInfo = lookups[key]
+                count('mb_lookups', result='shared')
+            else:
+                with stage('mb_lookup'):
+                    songInfo = lookups[key] = getMBinfo(config, song['title'], song[artist][0]['name'], mbIndex)
+                count('mb_lookups', result='found' if songInfo else 'missing')
             if songInfo:
                 MBdata[song['videoId']] = songInfo
-        saveCache(cacheFile, MBfile, MBdata, None)
+                misses.pop(song['videoId'], None)
+                putMBinfo(conn, song['videoId'], songInfo)
+            else:
+                misses[song['videoId']] = time.time() + retryAfter
+                putMBmiss(conn, song['videoId'], misses[song['videoId']])
+            # commit regularly so a crash does not throw away hours of lookups
+            unsaved += 1
+            if unsaved >= checkpointSongs or time.time() - lastSave >= checkpointSeconds:
+                commitStore(conn)
+                unsaved = 0
+                lastSave = time.time()
+        commitStore(conn)
     return MBdata
 
 def convertMBdata(MBdata):
@@ -0,0 +1,191 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# watch music folders for files that were added or changed and hand them out in batches.
+# on Linux the kernel's inotify reports every file as soon as whoever wrote it closes it, or when it is moved
+# into a watched folder. inotify does not watch subfolders, so every folder gets its own watch and new folders
+# are watched as they appear. anywhere else, or when inotify runs out of watches, the folders are polled and
+# a file is reported once its size and modification time are the same in two scans in a row
+
+# inotify flags, from sys/inotify.h
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+watchMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+eventHeader = struct.Struct('iIII')
+
+# files that are still being written by a download or rip, or that are not music
+ignoredSuffixes = ('.part', '.partial', '.tmp', '.crdownload', '.download', '.m3u', '.m3u8', '.pls', '.jpg', '.jpeg', '.png', '.txt', '.log', '.cue', '.nfo')
+
+def ignored(path):
+    name = os.path.basename(path)
+    return name.startswith('.') or name.lower().endswith(ignoredSuffixes)
+
+# every file under roots
+def walkFiles(roots):
+    for root in roots:
+        for dirName, subdirList, fileList in os.walk(root):
+            subdirList[:] = [d for d in subdirList if not d.startswith('.')]
+            for filename in fileList:
+                yield os.path.join(dirName, filename)
+
+class InotifyWatcher:
+    def __init__(self, roots):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.addWatch = libc.inotify_add_watch
+        self.addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        self.roots = roots
+        try:
+            for root in roots:
+                self.watchTree(root)
+        except OSError:
+            self.close()
+            raise
+
+    # watch a folder and every folder under it, and return the files already in them
+    def watchTree(self, folder):
+        found = []
+        for dirName, subdirList, fileList in os.walk(folder):
+            subdirList[:] = [d for d in subdirList if not d.startswith('.')]
+            wd = self.addWatch(self.fd, os.fsencode(dirName), watchMask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                # the folder was removed while it was being walked
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                # ENOSPC means fs.inotify.max_user_watches is used up
+                raise OSError(err, f'Could not watch {dirName}: {os.strerror(err)}')
+            self.folders[wd] = dirName
+            found += [os.path.join(dirName, filename) for filename in fileList]
+        return found
+
+    # wait up to timeout seconds and return the files that were written or moved in
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset + eventHeader.size <= len(data):
+            wd, mask, cookie, length = eventHeader.unpack_from(data, offset)
+            name = data[offset + eventHeader.size:offset + eventHeader.size + length].rstrip(b'\0')
+            offset += eventHeader.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, so every file could have changed
+                changed += walkFiles(self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # a folder moved in brings its files without any events for them, and a new folder can be
+                # written to before its watch is added, so both are walked
+                if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                    try:
+                        changed += self.watchTree(path)
+                    except OSError as err:
+                        print(f'\t{err}')
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher:
+    def __init__(self, roots, interval):
+        self.roots = roots
+        self.interval = interval
+        self.nextScan = time.monotonic() + interval
+        self.seen = self.scan()
+        self.reported = dict(self.seen)
+
+    def scan(self):
+        seen = {}
+        for path in walkFiles(self.roots):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+        return seen
+
+    # wait up to timeout seconds, scanning when one is due, and return the files that settled since the last report
+    def read(self, timeout):
+        wait = self.nextScan - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.nextScan = time.monotonic() + self.interval
+        previous, self.seen = self.seen, self.scan()
+        changed = [path for path, stat in self.seen.items() if previous.get(path) == stat and self.reported.get(path) != stat]
+        for path in changed:
+            self.reported[path] = self.seen[path]
+        return changed
+
+    def close(self):
+        pass
+
+# inotify where it works, polling everywhere else
+def openWatcher(roots, pollInterval):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as err:
+            print(f'Can not use inotify ({err}), checking for new files every {pollInterval:g} seconds instead')
+    return PollWatcher(roots, pollInterval)
+
+# yield batches of the files a watcher from openWatcher reports.
+# a batch is handed out once no file has changed for debounce seconds, so an album that is copied in
+# arrives as one batch, or after maxWait seconds when files keep coming.
+# idle: yield an empty batch after this many seconds without changes, so the caller gets to do other work
+def watchBatches(watcher, debounce=2, maxWait=60, idle=None):
+    pending = {}
+    firstEvent = lastEvent = None
+    while True:
+        timeout = idle
+        if pending:
+            now = time.monotonic()
+            timeout = max(0, min(lastEvent + debounce, firstEvent + maxWait) - now)
+        changed = [path for path in watcher.read(timeout) if not ignored(path)]
+        now = time.monotonic()
+        for path in changed:
+            pending[path] = now
+            firstEvent = firstEvent or now
+            lastEvent = now
+        if not pending:
+            if not changed:
+                yield []
+            continue
+        if now - lastEvent >= debounce or now - firstEvent >= maxWait:
+            batch = [path for path in pending if os.path.isfile(path)]
+            pending = {}
+            firstEvent = lastEvent = None
+            yield batch
@@ -0,0 +1,58 @@
+import re
+
+# characters fuzzywuzzy strips when force_ascii is set, and its token splitter
+asciiTable = dict((i, None) for i in range(128, 256))
+nonWord = re.compile(r'(?ui)\W')
+
+# normalize a string the same way fuzzywuzzy's full_process does before scoring
+def normalize(value):
+    if not isinstance(value, str):
+        value = str(value)
+    return nonWord.sub(' ', value.translate(asciiTable)).lower().strip()
+
+# padded character trigrams for every token, so even one letter tokens produce a gram
+def tokenGrams(value):
+    grams = set()
+    for token in normalize(value).split():
+        padded = f' {token} '
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+# build an inverted index of title trigrams -> positions in songList
+# songs without a title are kept aside since keyCheck skips that key for them
+def buildIndex(songList, key='title'):
+    index = {'key': key, 'grams': {}, 'always': [], 'size': len(songList or [])}
+    for position, song in enumerate(songList or []):
+        value = song.get(key)
+        grams = tokenGrams(value) if value else None
+        if not grams:
+            index['always'].append(position)
+            continue
+        for gram in grams:
+            index['grams'].setdefault(gram, []).append(position)
+    return index
+
+# return the songs that share at least one trigram with value, in their original order.
+# token_set_ratio can only reach wordRatio/phraseRatio for strings that share grams,
+# so filterSongs makes the same decisions on this shortlist as on the whole list
+def candidates(index, songList, value):
+    if not songList:
+        return songList
+    # the index is stale or the query is unusable, so fall back to a full scan
+    if not index or index['size'] != len(songList):
+        return songList
+    positions = candidatePositions(index, value)
+    if positions is None:
+        return songList
+    return [songList[p] for p in sorted(positions)]
+
+# the positions of the songs that share at least one trigram with value, or None when value has no grams
+def candidatePositions(index, value):
+    grams = tokenGrams(value) if value else None
+    if not grams:
+        return None
+    positions = set(index['always'])
+    for gram in grams:
+        positions.update(index['grams'].get(gram, ()))
+    return positions
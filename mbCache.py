@@ -0,0 +1,101 @@
+from stateStore import getMBcache, putMBcache
+from metrics import count
+
+# persistent cache for the lookups the oldest date plugin makes, kept in the mbcache table of the state database.
+# the plugin fetches a recording, then the work it is a performance of, then possibly every recording of that work,
+# and forgets them all when it is done. the cache keeps, by MBID:
+#   recording: the parts of a recording the plugin reads, its work relations, artist ids and release dates
+#   work: the recording relations of a work
+#   oldest: the oldest year found for a recording, and oldestwork: for every recording of a work that is not a cover
+# so songs on the same album or of the same work never ask MusicBrainz twice. release dates come with the
+# recording lookup, the plugin never fetches releases or release groups on their own
+
+settings = {'conn': None, 'maxAge': 90 * 86400}
+missing = object()
+
+# conn: the state database, None turns the cache off. maxAgeDays: how long entries are trusted
+def configureMBcache(conn, maxAgeDays=90):
+    settings['conn'] = conn
+    settings['maxAge'] = maxAgeDays * 86400
+
+def cached(kind, mbID):
+    if settings['conn'] is None or not mbID:
+        return missing
+    found, value = getMBcache(settings['conn'], kind, mbID, settings['maxAge'])
+    count('mb_cache', kind=kind, result='hit' if found else 'miss')
+    return value if found else missing
+
+def remember(kind, mbID, value):
+    if settings['conn'] is not None and mbID:
+        putMBcache(settings['conn'], kind, mbID, value)
+
+# only what the plugin reads, a popular recording has hundreds of releases with far more in each
+def trimRecording(recording):
+    trimmed = {'id': recording.get('id')}
+    if 'artist-credit' in recording:
+        trimmed['artist-credit'] = [{'artist': {'id': c['artist']['id']}} for c in recording['artist-credit'] if isinstance(c, dict) and 'id' in c.get('artist', {})]
+    if 'work-relation-list' in recording:
+        trimmed['work-relation-list'] = [{k: r[k] for k in ('work', 'attribute-list') if k in r} for r in recording['work-relation-list']]
+        for relation in trimmed['work-relation-list']:
+            if 'work' in relation:
+                relation['work'] = {'id': relation['work'].get('id')}
+    if 'release-list' in recording:
+        trimmed['release-list'] = [{k: r[k] for k in ('status', 'date') if k in r} for r in recording['release-list']]
+    return trimmed
+
+def trimWork(work):
+    trimmed = {'id': work.get('id')}
+    if 'recording-relation-list' in work:
+        trimmed['recording-relation-list'] = [{k: r[k] for k in ('recording', 'attribute-list', 'begin') if k in r} for r in work['recording-relation-list']]
+        for relation in trimmed['recording-relation-list']:
+            if 'recording' in relation:
+                relation['recording'] = {'id': relation['recording'].get('id')}
+    return trimmed
+
+# route the plugin's recording and work lookups through the cache
+def cacheOldestDate(od):
+    import beetsplug.oldestdate as plugin
+    fetchRecording = od._fetch_recording
+    fetchWork = plugin._fetch_work
+    if getattr(fetchWork, 'cached', False):
+        return od
+
+    def cachedRecording(recordingId):
+        recording = cached('recording', recordingId)
+        if recording is missing:
+            recording = trimRecording(fetchRecording(recordingId))
+            remember('recording', recordingId, recording)
+        # the plugin keeps the recordings it is still working through in memory, like its own fetch does
+        od._recordings_cache[recordingId] = recording
+        return recording
+
+    def cachedWork(workId):
+        work = cached('work', workId)
+        if work is missing:
+            work = trimWork(fetchWork(workId))
+            remember('work', workId, work)
+        return work
+
+    cachedWork.cached = True
+    od._fetch_recording = cachedRecording
+    plugin._fetch_work = cachedWork
+    return od
+
+# the oldest release year of a recording, or None. every recording of a work that is not a cover
+# has the same oldest date, so it is also remembered for the work
+def oldestYear(od, recordingId):
+    from beetsplug.oldestdate import _get_work_id_from_recording, _is_cover
+    approach = od.config['approach'].get()
+    year = cached(f'oldest:{approach}', recordingId)
+    if year is not missing:
+        return year
+    recording = od._get_recording(recordingId)
+    workId = None if _is_cover(recording) else _get_work_id_from_recording(recording)
+    year = cached(f'oldestwork:{approach}', workId)
+    if year is missing:
+        oldest = od._get_oldest_date(recordingId, None)
+        year = oldest.y if oldest else None
+        remember(f'oldestwork:{approach}', workId, year)
+    od._recordings_cache.pop(recordingId, None)
+    remember(f'oldest:{approach}', recordingId, year)
+    return year
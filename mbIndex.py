@@ -0,0 +1,155 @@
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import os
+import sqlite3
+import tarfile
+import time
+from matchIndex import normalize
+
+# offline MusicBrainz index built from a data dump, so getMBinfo can find most songs without the web service.
+# every recording is one row keyed by its normalized title and artist credit, with the year it was first
+# released and its genres and tags. a dump can be:
+#   the MusicBrainz JSON dump of recordings (one recording per line, as in mbdump/recording of recording.tar.xz)
+#   a TSV file with a header naming the columns id, artist, title, length, date and genres (genres split by ;)
+# plain, gzip, bz2 or xz compressed, or tar archives of those
+
+schema = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    mbID TEXT PRIMARY KEY,
+    titleKey TEXT NOT NULL,
+    artistKey TEXT NOT NULL,
+    title TEXT,
+    artist TEXT,
+    length INTEGER,
+    year INTEGER,
+    genres TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# open the index read only, or return None when there is none
+def openMBindex(indexFile):
+    if not indexFile or not os.path.exists(indexFile):
+        return None
+    return sqlite3.connect(f'file:{indexFile}?mode=ro', uri=True, check_same_thread=False)
+
+# the recordings with the same normalized title, the ones with the same artist credit first
+# songs are returned the way getMBinfo reads search results
+def indexCandidates(index, title, artist, limit=200):
+    titleKey = normalize(title)
+    rows = index.execute('SELECT mbID, title, artist, length, year, genres FROM recordings WHERE titleKey = ? AND artistKey = ?', (titleKey, normalize(artist))).fetchall()
+    # credits like "Artist feat. Someone" only match by fuzzy artist
+    if not rows:
+        rows = index.execute('SELECT mbID, title, artist, length, year, genres FROM recordings WHERE titleKey = ? LIMIT ?', (titleKey, limit)).fetchall()
+    return [{'id': mbID, 'title': title, 'artist-credit': artist, 'length': length, 'year': year, 'genres': json.loads(genres)}
+            for mbID, title, artist, length, year, genres in rows]
+
+# a row for one recording from the JSON dump, or None for recordings without a title
+def jsonRecording(record):
+    if not record.get('id') or not record.get('title'):
+        return None
+    artist = ''.join(c.get('name', '') + c.get('joinphrase', '') for c in record.get('artist-credit') or [])
+    dates = [record.get('first-release-date')] + [r.get('date') for r in record.get('releases') or []]
+    years = [int(d[:4]) for d in dates if d and d[:4].isdigit()]
+    genres = []
+    for tag in (record.get('genres') or []) + (record.get('tags') or []):
+        if tag.get('name') and tag['name'] not in genres:
+            genres.append(tag['name'])
+    return recordingRow(record['id'], artist, record['title'], record.get('length'), min(years) if years else None, genres)
+
+# a row for one line of a TSV dump
+def tsvRecording(record):
+    mbID = record.get('id') or record.get('mbid')
+    if not mbID or not record.get('title'):
+        return None
+    date = record.get('date') or record.get('year') or ''
+    genres = [g.strip() for g in (record.get('genres') or record.get('tags') or '').split(';') if g.strip()]
+    length = record.get('length')
+    return recordingRow(mbID, record.get('artist') or '', record['title'], int(length) if length and length.isdigit() else None,
+                        int(date[:4]) if date[:4].isdigit() else None, genres)
+
+def recordingRow(mbID, artist, title, length, year, genres):
+    return (mbID, normalize(title), normalize(artist), title, artist, length, year, json.dumps(genres))
+
+# open a dump file as text, whatever it is compressed with
+def openDump(filename):
+    opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, 'rt', encoding='utf-8')
+
+# yield the rows of every recording in a dump file or archive
+def dumpRows(filename):
+    if tarfile.is_tarfile(filename):
+        with tarfile.open(filename, 'r:*') as archive:
+            for member in archive:
+                name = os.path.basename(member.name)
+                # the JSON dumps keep their recordings in mbdump/recording, next to README and COPYING files
+                if member.isfile() and (name == 'recording' or name.endswith(('.json', '.jsonl', '.tsv'))):
+                    with io.TextIOWrapper(archive.extractfile(member), encoding='utf-8') as f:
+                        yield from fileRows(f, name.endswith('.tsv'))
+        return
+    with openDump(filename) as f:
+        yield from fileRows(f, '.tsv' in filename.lower())
+
+def fileRows(f, isTsv):
+    if isTsv:
+        for record in csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            row = tsvRecording({k.strip().lower(): v for k, v in record.items() if k})
+            if row:
+                yield row
+        return
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = jsonRecording(json.loads(line))
+        except (ValueError, AttributeError, TypeError):
+            continue
+        if row:
+            yield row
+
+# build the index from one or more dumps. it is written next to indexFile and only replaces it once complete,
+# so an interrupted import leaves the old index in place
+def importDumps(indexFile, dumps, batchSize=10000):
+    from tqdm import tqdm
+    tmpFile = f'{indexFile}.tmp'
+    if os.path.exists(tmpFile):
+        os.remove(tmpFile)
+    conn = sqlite3.connect(tmpFile)
+    # nothing else reads the file until it is complete, so it does not need a journal
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.executescript(schema)
+    imported = 0
+    try:
+        with tqdm(unit=' recordings') as progress:
+            for dump in dumps:
+                batch = []
+                for row in dumpRows(dump):
+                    batch.append(row)
+                    if len(batch) >= batchSize:
+                        conn.executemany('INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                        progress.update(len(batch))
+                        imported += len(batch)
+                        batch = []
+                conn.executemany('INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                progress.update(len(batch))
+                imported += len(batch)
+        # the index is built once at the end, which is much faster than keeping it up to date row by row
+        conn.execute('CREATE INDEX recordingsByTitle ON recordings (titleKey, artistKey)')
+        conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('imported', json.dumps(time.time())), ('dumps', json.dumps([os.path.basename(d) for d in dumps]))])
+        conn.commit()
+        conn.close()
+    except BaseException:
+        conn.close()
+        os.remove(tmpFile)
+        raise
+    os.replace(tmpFile, indexFile)
+    return imported
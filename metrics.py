@@ -0,0 +1,143 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# counters and latency histograms for one run, written as a JSON summary and a Prometheus textfile
+# metrics are identified by name and a few labels, e.g. observe('api_seconds', 0.2, service='ytmusic', method='search')
+# every function is safe to call from the search, delete and upload threads
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+prefix = 'ytsync_'
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+started = time.time()
+
+def metricKey(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def count(name, value=1, **labels):
+    key = metricKey(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = metricKey(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if not histogram:
+            histogram = histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0, 'max': 0.0}
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        histogram['max'] = max(histogram['max'], seconds)
+
+# time a block of code into a histogram
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+# time the main stages of a command, e.g. with stage('match'):
+def stage(name):
+    return timer('stage_seconds', stage=name)
+
+# replace functions on an object or module with ones that record their latency and errors
+# names defaults to every public method, so it covers the whole YTMusic api
+def instrument(target, service, names=None):
+    names = names or [n for n in dir(type(target)) if not n.startswith('_') and callable(getattr(type(target), n, None))]
+    for name in names:
+        func = getattr(target, name, None)
+        if func is None or getattr(func, 'instrumented', False):
+            continue
+        setattr(target, name, timedCall(func, service, name))
+    # count the bytes that go over the YTMusic requests session
+    session = getattr(target, '_session', None)
+    if session is not None and hasattr(session, 'hooks'):
+        session.hooks['response'].append(countBytes)
+    return target
+
+def timedCall(func, service, method):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            count('api_errors', service=service, method=method)
+            raise
+        finally:
+            observe('api_seconds', time.perf_counter() - start, service=service, method=method)
+    wrapper.instrumented = True
+    wrapper.__name__ = method
+    return wrapper
+
+def countBytes(response, *args, **kwargs):
+    count('http_bytes', len(response.content or b''), direction='received')
+    body = response.request.body if response.request is not None else None
+    if body:
+        count('http_bytes', len(body), direction='sent')
+
+def summary():
+    with lock:
+        result = {'started': started, 'seconds': round(time.time() - started, 3), 'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': round(value, 6)})
+        for (name, labels), h in sorted(histograms.items()):
+            result['histograms'].setdefault(name, []).append({'labels': dict(labels), 'count': h['count'], 'sum': round(h['sum'], 6),
+                                                              'mean': round(h['sum'] / h['count'], 6), 'max': round(h['max'], 6)})
+    return result
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+# metrics in the Prometheus text format, for the node exporter textfile collector
+def prometheusText(runLabels):
+    runLabels = tuple(sorted((k, str(v)) for k, v in runLabels.items()))
+    lines = []
+    with lock:
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = f'{prefix}{name}_total'
+            if metric not in seen:
+                lines.append(f'# TYPE {metric} counter')
+                seen.add(metric)
+            lines.append(f'{metric}{formatLabels(runLabels + labels)} {value}')
+        for (name, labels), h in sorted(histograms.items()):
+            metric = f'{prefix}{name}'
+            if metric not in seen:
+                lines.append(f'# TYPE {metric} histogram')
+                seen.add(metric)
+            for bound, bucketCount in zip(buckets, h['buckets']):
+                lines.append(f'{metric}_bucket{formatLabels(runLabels + labels + (("le", str(bound)),))} {bucketCount}')
+            lines.append(f'{metric}_bucket{formatLabels(runLabels + labels + (("le", "+Inf"),))} {h["count"]}')
+            lines.append(f'{metric}_sum{formatLabels(runLabels + labels)} {h["sum"]}')
+            lines.append(f'{metric}_count{formatLabels(runLabels + labels)} {h["count"]}')
+    lines.append(f'# TYPE {prefix}run_seconds gauge')
+    lines.append(f'{prefix}run_seconds{formatLabels(runLabels)} {time.time() - started}')
+    lines.append(f'# TYPE {prefix}run_timestamp_seconds gauge')
+    lines.append(f'{prefix}run_timestamp_seconds{formatLabels(runLabels)} {time.time()}')
+    return '\n'.join(lines) + '\n'
+
+# write both files at the end of a run. they are replaced in one step so a scraper never reads half a file
+# runLabels are added to every metric, e.g. the command and whether it finished
+def writeMetrics(jsonFile, promFile, **runLabels):
+    for fileName, text in [(jsonFile, lambda: json.dumps(dict(summary(), run=runLabels), indent=2)), (promFile, lambda: prometheusText(runLabels))]:
+        if not fileName:
+            continue
+        try:
+            with open(f'{fileName}.tmp', 'w') as f:
+                f.write(text())
+            os.replace(f'{fileName}.tmp', fileName)
+        except Exception as err:
+            print(f'Problem writing metrics to {fileName}: {err}')
@@ -0,0 +1,70 @@
+import ntpath
+import os
+import re
+from urllib.parse import unquote, urlparse
+from utils import openFile
+
+# read M3U, M3U8 and PLS playlists into the files they list.
+# entries can be absolute, relative to the playlist's folder, file:// urls or paths written on Windows;
+# streams and other urls are skipped since there is no local file to match
+
+playlistTypes = ('.m3u', '.m3u8', '.pls')
+
+def isPlaylist(filename):
+    return os.path.splitext(filename)[1].lower() in playlistTypes
+
+# the name the playlist gets on YT Music
+def playlistName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+# every playlist file named in query, directories are searched for playlists
+def findPlaylists(query):
+    found = []
+    for path in query:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(dirName, filename) for dirName, subdirList, fileList in os.walk(path) for filename in fileList if isPlaylist(filename))
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            print(f'{path} is not a valid file or directory.')
+    return found
+
+# the file a playlist entry points to, or None for streams and paths that can not exist here
+def entryPath(entry, base):
+    if entry.lower().startswith('file://'):
+        entry = unquote(urlparse(entry).path)
+        # file:///C:/Music/a.mp3 has the drive after the slash
+        if re.match(r'/[A-Za-z]:', entry):
+            entry = entry[1:]
+    elif '://' in entry:
+        return None
+    # a Windows drive or network path would otherwise be joined onto the playlist's folder as a relative path
+    if os.sep == '/' and ntpath.splitdrive(entry)[0] and not os.path.exists(os.path.join(base, entry)):
+        print(f'\tCan not find {entry}, a Windows path, on this computer')
+        return None
+    # playlists made on Windows use backslashes
+    if os.sep == '/' and '\\' in entry and not os.path.exists(entry):
+        entry = entry.replace('\\', '/')
+    return os.path.normpath(os.path.join(base, os.path.expanduser(entry)))
+
+# return the files a playlist lists in order, or None if it could not be read
+def readPlaylist(filename):
+    with openFile(filename, 'rb') as (f, err):
+        if err:
+            print(f'Problem opening playlist file: {err}')
+            return None
+        data = f.read()
+    # M3U8 is always UTF-8, older M3U and PLS files are often Latin-1
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    lines = [line.strip() for line in text.splitlines()]
+    if filename.lower().endswith('.pls'):
+        # FileN=path entries, the Title and Length lines are not needed
+        entries = [value.strip() for key, sep, value in (line.partition('=') for line in lines) if sep and key.strip().lower().startswith('file')]
+    else:
+        # skip comment lines like #EXTM3U and #EXTINF
+        entries = [line for line in lines if line and not line.startswith('#')]
+    base = os.path.dirname(os.path.abspath(filename))
+    return [path for path in (entryPath(entry, base) for entry in entries) if path]
@@ -0,0 +1,119 @@
+import re
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import count
+
+# token bucket shared by every thread that talks to YT Music
+# rate is requests per second, capacity is how many can go out in a burst
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.lock = threading.Lock()
+        self.configure(rate, capacity)
+
+    def configure(self, rate, capacity):
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(1, capacity)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+            self.blockedUntil = 0
+
+    # block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blockedUntil and (not self.rate or self.tokens >= 1):
+                    if self.rate:
+                        self.tokens -= 1
+                    return
+                if now < self.blockedUntil:
+                    delay = self.blockedUntil - now
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            count('ratelimit_wait_seconds', delay)
+            time.sleep(delay)
+
+    # stop every thread from sending requests for a while after the server pushed back
+    def pause(self, seconds):
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+            self.tokens = 0
+
+limiter = TokenBucket(10, 1)
+maxWorkers = 1
+
+# set the shared limits from the YTDelay and maxConcurrency config options
+def configureLimiter(delay, concurrency):
+    global maxWorkers
+    maxWorkers = max(1, concurrency)
+    limiter.configure(1 / delay if delay else 0, maxWorkers)
+
+# a keep-alive requests session for YTMusic that keeps a connection open for every thread that can use it at once,
+# at least one for each collection loadCache downloads. requests get the 30 second timeout ytmusicapi gives its own session
+def pooledSession(workers=None, timeout=30):
+    import requests
+    from functools import partial
+    size = max(workers or maxWorkers, 4)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.request = partial(session.request, timeout=timeout)
+    return session
+
+# find the HTTP status code in an exception raised by ytmusicapi, requests or musicbrainzngs
+def httpStatus(err):
+    response = getattr(err, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return response.status_code
+    cause = getattr(err, 'cause', None)
+    if cause is not None and getattr(cause, 'code', None):
+        return cause.code
+    match = re.search(r'HTTP (?:Error )?(\d{3})', str(err))
+    return int(match.group(1)) if match else None
+
+# call a YT Music function under the shared rate limit
+# throttling and server errors are retried with exponential backoff, anything else is raised
+def limitedCall(func, *args, retries=5, **kwargs):
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            status = httpStatus(err)
+            if attempt >= retries or status is None or (status != 429 and status < 500):
+                raise
+            backoff = min(60, 2 ** attempt) + random.random()
+            print(f'\tServer returned HTTP {status}, retrying in {backoff:.1f} seconds')
+            count('api_retries', method=getattr(func, '__name__', 'unknown'), code=status)
+            limiter.pause(backoff)
+            attempt += 1
+
+# run func(*item) for every item on a pool of threads and yield (item, result) as they finish
+# only a few items are started ahead of the results so a long generator is never read ahead
+def runBounded(func, items, workers=None, window=None):
+    workers = workers or maxWorkers
+    if workers <= 1:
+        for item in items:
+            yield item, func(*item)
+        return
+    window = window or workers * 2
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {}
+        for item in items:
+            pending[pool.submit(func, *item)] = item
+            if len(pending) >= window:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
@@ -0,0 +1,60 @@
+from matchIndex import normalize
+
+# work out what has to change between uploads, library and liked songs with set operations
+# over indexes, instead of scanning one collection for every song of another.
+# a plan is a list of (action, collection, song) tuples, where action is 'add' or 'remove'
+
+# uploads use 'artist' and the other collections 'artists'
+def firstArtist(song):
+    artists = song.get('artists') or song.get('artist') or []
+    if isinstance(artists, list):
+        return artists[0]['name'] if artists else ''
+    return artists.get('name', '') if isinstance(artists, dict) else str(artists)
+
+# normalized title and artist, so a catalog song and an upload of the same recording share a key
+def nameKey(song):
+    return (normalize(song.get('title') or ''), normalize(firstArtist(song)))
+
+def buildIndex(songs):
+    index = {'videoIds': {}, 'entityIds': {}, 'keys': {}}
+    for song in songs or []:
+        if song.get('videoId'):
+            index['videoIds'][song['videoId']] = song
+        if song.get('entityId'):
+            index['entityIds'][song['entityId']] = song
+        index['keys'].setdefault(nameKey(song), []).append(song)
+    return index
+
+# index every collection once, keyed by the names used in plans
+def buildIndexes(uploads, library, likedTracks):
+    return {'uploads': buildIndex(uploads), 'library': buildIndex(library), 'likes': buildIndex(likedTracks)}
+
+# liked songs that are not in the library. songs without feedback tokens are videos and can not be added
+def planLikes(indexes):
+    library = indexes['library']['videoIds']
+    missing = [song for videoId, song in indexes['likes']['videoIds'].items() if videoId not in library]
+    plan = [('add', 'library', song) for song in missing if song.get('feedbackTokens')]
+    videos = [song for song in missing if not song.get('feedbackTokens')]
+    return plan, videos
+
+# uploads that have the same title and artist as a song in the library
+def planDuplicateUploads(indexes):
+    libraryKeys = set(indexes['library']['keys'])
+    return [('remove', 'uploads', song) for key in set(indexes['uploads']['keys']) & libraryKeys
+            for song in indexes['uploads']['keys'][key]]
+
+# remove every song from every collection
+# this works from the full lists rather than the indexes, which drop songs without an id and collapse songs that
+# share one. a song is only left out when it lacks what removing it takes, like a library song without feedback tokens
+def planDeleteAll(uploads, library, likedTracks):
+    plan = [('remove', 'uploads', song) for song in uploads or [] if song.get('entityId')]
+    plan += [('remove', 'library', song) for song in library or [] if song.get('feedbackTokens')]
+    plan += [('remove', 'likes', song) for song in likedTracks or [] if song.get('videoId')]
+    return plan
+
+# group a plan by action and collection, keeping the order of the plan
+def groupPlan(plan):
+    groups = {}
+    for action, collection, song in plan:
+        groups.setdefault((action, collection), []).append(song)
+    return groups
@@ -0,0 +1,66 @@
+# evaluate smart playlist rules from getRule with set operations over indexes of MBdata
+# a song matches a rule the same way the old per song loop decided it:
+#   year and genre rules: songs in the years that match a genre (and no ^genre),
+#       songs in the years without any genres, and songs without a year that match a genre
+#   year rules only: every song in the years
+#   genre rules only: every song that matches a genre and no ^genre
+# genre rules match by substring, so "rock" matches "hard rock" and "rock and roll"
+
+# index MBdata once: videoIds by year and by every distinct genre
+def buildRuleIndex(MBdata):
+    index = {'years': {}, 'noYear': set(), 'genres': {}, 'exactGenres': {}, 'noGenres': set(), 'matches': {}}
+    for videoId, song in MBdata.items():
+        year = song.get('year')
+        if year:
+            index['years'].setdefault(int(year), set()).add(videoId)
+        else:
+            index['noYear'].add(videoId)
+        genres = song.get('genres')
+        if not genres:
+            index['noGenres'].add(videoId)
+            continue
+        for genre in genres:
+            # genres taken from release tags are lists, where the old check was list membership
+            if isinstance(genre, list):
+                for tag in genre:
+                    index['exactGenres'].setdefault(tag, set()).add(videoId)
+            else:
+                index['genres'].setdefault(genre, set()).add(videoId)
+    return index
+
+# return the videoIds that have a genre containing any of the rule genres
+# the substring search runs once per rule genre over the genre vocabulary, not once per song
+def genreMatches(index, ruleGenres):
+    songs = set()
+    for r in ruleGenres:
+        if r not in index['matches']:
+            matched = set(index['exactGenres'].get(r, ()))
+            for genre, videoIds in index['genres'].items():
+                if r in genre:
+                    matched |= videoIds
+            index['matches'][r] = matched
+        songs |= index['matches'][r]
+    return songs
+
+# return the set of videoIds that belong in the playlist for one rule
+def evaluateRule(index, rule):
+    hasYear = 'year' in rule
+    hasGenre = 'genre' in rule
+    if hasYear:
+        inYears = set()
+        for year in rule['year']:
+            inYears |= index['years'].get(year, set())
+    if hasGenre:
+        genreSongs = genreMatches(index, rule['genre']) - genreMatches(index, rule.get('notGenre', []))
+    if hasYear and hasGenre:
+        return (inYears & (genreSongs | index['noGenres'])) | (genreSongs & index['noYear'])
+    if hasYear:
+        return inYears
+    if hasGenre:
+        return genreSongs
+    return set()
+
+# compile every playlist rule against MBdata and return {playlist name: set of videoIds}
+def compileRules(rules, MBdata):
+    index = buildRuleIndex(MBdata)
+    return {name: evaluateRule(index, rule) for name, rule in rules.items()}
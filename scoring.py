@@ -0,0 +1,132 @@
+import os
+from functools import lru_cache
+from matchIndex import normalize, nonWord
+
+# batched token_set_ratio scoring for filterSongs.
+# a check scores one query against a whole column of song fields at once, with rapidfuzz when it
+# is installed (cdist spreads a matrix over every core when numpy is there too) and fuzzywuzzy otherwise.
+# the accept/reject decisions are the same as keyCheck made with fuzzywuzzy one pair at a time
+
+# the scoring libraries are imported the first time songs are scored, so commands that never match
+# anything do not pay for them. configureScoring only records what was asked for
+fuzz = None
+rfProcess = rfFuzz = None
+numpy = None
+settings = {'requested': 'auto', 'backend': None, 'workers': 1}
+# cdist only pays for its threads on big matrices
+parallelCells = 50000
+
+# choose the backend: auto, rapidfuzz or fuzzywuzzy. workers 0 means one per CPU
+def configureScoring(backend='auto', workers=0):
+    settings['requested'] = backend
+    settings['backend'] = None
+    settings['workers'] = workers or os.cpu_count() or 1
+
+# import the libraries for the configured backend and return its name
+def loadBackend():
+    global fuzz, rfProcess, rfFuzz, numpy
+    if settings['backend']:
+        return settings['backend']
+    from fuzzywuzzy import fuzz
+    try:
+        from rapidfuzz import process as rfProcess, fuzz as rfFuzz
+    except ImportError:
+        rfProcess = None
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    # rapidfuzz only gives the same scores as fuzzywuzzy when fuzzywuzzy uses python-Levenshtein,
+    # the difflib fallback scores differently
+    levenshtein = fuzz.SequenceMatcher.__module__ != 'difflib'
+    backend = settings['requested']
+    if backend in ('auto', 'rapidfuzz') and rfProcess and levenshtein:
+        settings['backend'] = 'rapidfuzz'
+    else:
+        if backend == 'rapidfuzz':
+            print('rapidfuzz is not installed or fuzzywuzzy is not using python-Levenshtein, using fuzzywuzzy')
+        settings['backend'] = 'fuzzywuzzy'
+    return settings['backend']
+
+# keyCheck lowercases strings before fuzzywuzzy processes them, while lists and dicts are scored by their repr
+@lru_cache(maxsize=1 << 18)
+def stringText(value):
+    return normalize(value.lower())
+
+# keyCheck scores a dict with a name by the name, and other lists and dicts by their repr
+def collectionText(value):
+    return normalize(value['name'] if isinstance(value, dict) and 'name' in value else value)
+
+# the processed repr of a list or dict by identity. the field is kept in the entry, so its id
+# can not be reused by another object while the entry exists
+collectionTexts = {}
+
+def fieldText(value):
+    if not isinstance(value, (list, dict)):
+        return stringText(value)
+    entry = collectionTexts.get(id(value))
+    if entry and entry[0] is value:
+        return entry[1]
+    text = collectionText(value)
+    if len(collectionTexts) >= 1 << 20:
+        collectionTexts.clear()
+    collectionTexts[id(value)] = (value, text)
+    return text
+
+# process.extractOne runs the query through full_process without force_ascii before the scorer's own pass
+def queryText(value, isCollection):
+    return normalize(nonWord.sub(' ', value).lower().strip()) if isCollection else stringText(value)
+
+# return the positions of texts whose score against query rounds to at least ratio
+def acceptedRows(query, texts, ratio):
+    return acceptedMatrix([query], texts, ratio)[0]
+
+# score every query against every text and return one set of accepted text positions per query
+def acceptedMatrix(queries, texts, ratio):
+    if not texts:
+        return [set() for q in queries]
+    if ratio <= 0:
+        return [set(range(len(texts))) for q in queries]
+    if loadBackend() != 'rapidfuzz':
+        return [{i for i, text in enumerate(texts) if fuzz.token_set_ratio(q, text, full_process=False) >= ratio} for q in queries]
+    # fuzzywuzzy rounds each score to an int, so anything above ratio - 0.5 is accepted.
+    # rapidfuzz works in floats, so scores right at the rounding point are scored again by fuzzywuzzy
+    cutoff = ratio - 0.5
+    if numpy is not None:
+        workers = settings['workers'] if len(queries) * len(texts) >= parallelCells else 1
+        matrix = rfProcess.cdist(queries, texts, scorer=rfFuzz.token_set_ratio, processor=None, score_cutoff=cutoff - 1e-6, workers=workers)
+        rows = [[(i, float(row[i])) for i in numpy.flatnonzero(row)] for row in matrix]
+    else:
+        rows = [[(i, score) for text, score, i in rfProcess.extract(q, texts, scorer=rfFuzz.token_set_ratio, processor=None, limit=None, score_cutoff=cutoff - 1e-6)] for q in queries]
+    accepted = []
+    for q, row in zip(queries, rows):
+        accepted.append({int(i) for i, score in row if score > cutoff + 1e-6 or fuzz.token_set_ratio(q, texts[i], full_process=False) >= ratio})
+    return accepted
+
+# the keyCheck result for every song: each (key, value, ratio) check is scored as one batch over the
+# songs that have that key, and songs combine their checks with AND/OR depending on matchAll
+def checkSongs(songList, checks, matchAll):
+    groups = {}
+    for c, (key, value, ratio) in enumerate(checks):
+        queries = {True: queryText(value, True), False: queryText(value, False)}
+        for i, song in enumerate(songList):
+            field = song.get(key)
+            if not field:
+                continue
+            # checks with the same query and ratio share one scoring call over all their columns
+            group = groups.setdefault((queries[isinstance(field, (list, dict))], ratio), ([], []))
+            group[0].append((c, i))
+            # song records carry their texts already
+            text = getattr(song, 'text', None)
+            group[1].append(text(key) if text else fieldText(field))
+    present = [set() for song in songList]
+    passed = [set() for song in songList]
+    for (query, ratio), (cells, texts) in groups.items():
+        accepted = acceptedRows(query, texts, ratio)
+        for position, (c, i) in enumerate(cells):
+            present[i].add(c)
+            if position in accepted:
+                passed[i].add(c)
+    if matchAll:
+        return [p == q for p, q in zip(present, passed)]
+    return [bool(q) for q in passed]
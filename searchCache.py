@@ -0,0 +1,33 @@
+import time
+from matchIndex import normalize
+
+# on-disk cache of raw ytmusic.search responses keyed by normalized query and search type.
+# responses that gave an acceptable match are kept in hits, the rest in misses with a shorter
+# TTL so songs that were missing get searched for again sooner.
+# searchYT always scores the cached results itself, so changing the ratios or ignored
+# artists and phrases takes effect without hitting the network again.
+
+def searchKey(query, type):
+    return (normalize(query), type)
+
+# return the cached results for a query, or None if it has to be searched again
+# hitTTL and missTTL are in days
+def cachedResults(cache, query, type, hitTTL, missTTL):
+    key = searchKey(query, type)
+    now = time.time()
+    entry = cache['hits'].get(key)
+    if entry and now - entry['time'] < hitTTL * 86400:
+        return entry['results']
+    entry = cache['misses'].get(key)
+    if entry and now - entry['time'] < missTTL * 86400:
+        return entry['results']
+    return None
+
+# remember the results of a search and whether they gave an acceptable match
+def storeResults(cache, query, type, results, matched):
+    key = searchKey(query, type)
+    entry = cache['hits'].pop(key, None) or cache['misses'].pop(key, None)
+    # rescoring cached results keeps the time of the original search
+    if not entry or entry['results'] is not results:
+        entry = {'time': time.time(), 'results': results}
+    cache['hits' if matched else 'misses'][key] = entry
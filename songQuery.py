@@ -0,0 +1,280 @@
+from matchIndex import buildIndex, candidatePositions, normalize
+from ruleEngine import buildRuleIndex, genreMatches
+from scoring import checkSongs
+
+# the query language of delete query and search
+#   words               fuzzy match on title, artist or album. words next to each other are one phrase
+#   field:value         fuzzy match on title, artist or album. only the first colon splits, so values can have colons
+#   field:=value        exact match, the field equals value apart from case and punctuation
+#   year:1990           songs MusicBrainz dates to 1990, or to 1990-1999, or to 1990,1995
+#   genre:rock          songs with a MusicBrainz genre containing rock
+#   AND, OR, NOT and parentheses combine terms, terms next to each other are ANDed
+# a query compiles to a tree of nodes that runs over a collection as set operations on song positions.
+# exact, year and genre terms are index lookups, and the terms of an AND run cheapest first, so fuzzy terms
+# only score the songs that are still in play and share a trigram with the value
+
+operators = ('AND', 'OR', 'NOT')
+textFields = ('title', 'artist', 'album')
+mbFields = ('year', 'genre')
+
+# split the command line into terms, operators and parentheses.
+# every argument is one term, so "artist:black eyed peas" keeps its spaces
+def tokenize(query):
+    tokens = []
+    for part in query:
+        while part.startswith('('):
+            tokens.append('(')
+            part = part[1:].strip()
+        # a closing parenthesis only ends a group when the value does not open one itself, like "Song (Live)"
+        closing = 0
+        while part.endswith(')') and part.count(')') > part.count('('):
+            closing += 1
+            part = part[:-1].strip()
+        if part:
+            tokens.append(part)
+        tokens += [')'] * closing
+    return tokens
+
+# a term token as a node. field terms only count for known fields, anything else is plain text
+def termNode(token):
+    field, sep, value = token.partition(':')
+    field = field.strip().lower()
+    if not sep or field not in textFields + mbFields:
+        return ('text', token)
+    value = value.strip()
+    if field == 'year':
+        return ('year', parseYears(value))
+    if field == 'genre':
+        if not value:
+            raise ValueError('genre: needs a genre')
+        return ('genre', value.lower())
+    if value.startswith('='):
+        value = value[1:].strip()
+        if not value:
+            raise ValueError(f'{field}:= needs a value')
+        return ('exact', field, value)
+    if not value:
+        raise ValueError(f'{field}: needs a value')
+    return ('fuzzy', field, value)
+
+# year values the way smart playlist rules take them: 1990, 1990-1999 or 1990,1995
+def parseYears(value):
+    try:
+        if ',' in value:
+            return {int(y) for y in value.split(',')}
+        if '-' in value:
+            start, end = value.split('-')
+            return set(range(int(start), int(end) + 1))
+        return {int(value)}
+    except ValueError:
+        raise ValueError(f'year:{value} is not a year or a range of years')
+
+# recursive descent over the tokens: OR binds loosest, then AND, then NOT
+def parseQuery(query):
+    tokens = tokenize(query)
+    if not tokens:
+        raise ValueError('the query is empty')
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def parseOr():
+        nodes = [parseAnd()]
+        while peek() == 'OR':
+            take()
+            nodes.append(parseAnd())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parseAnd():
+        nodes = [parseNot()]
+        while peek() is not None and peek() not in ('OR', ')'):
+            if peek() == 'AND':
+                take()
+            nodes.append(parseNot())
+        # plain words next to each other are one phrase, like the old simple match
+        merged = []
+        for node in nodes:
+            if node[0] == 'text' and merged and merged[-1][0] == 'text':
+                merged[-1] = ('text', f'{merged[-1][1]} {node[1]}')
+            else:
+                merged.append(node)
+        return merged[0] if len(merged) == 1 else ('and', merged)
+
+    def parseNot():
+        if peek() == 'NOT':
+            take()
+            return ('not', parseNot())
+        return parseAtom()
+
+    def parseAtom():
+        token = peek()
+        if token is None:
+            raise ValueError('the query ends too early')
+        if token == '(':
+            take()
+            node = parseOr()
+            if peek() != ')':
+                raise ValueError('a parenthesis is not closed')
+            take()
+            return node
+        if token in operators or token == ')':
+            raise ValueError(f'unexpected {token}')
+        return termNode(take())
+
+    node = parseOr()
+    if peek() is not None:
+        raise ValueError(f'unexpected {peek()}')
+    return node
+
+# parse a query and give its fuzzy terms their ratio: wordRatio for one word, phraseRatio for more,
+# or 100 for every term when exact is set (the -e option)
+def compileQuery(query, wordRatio, phraseRatio, exact=False):
+    def ratios(node):
+        kind = node[0]
+        if kind in ('and', 'or'):
+            return (kind, [ratios(n) for n in node[1]])
+        if kind == 'not':
+            return (kind, ratios(node[1]))
+        if kind in ('fuzzy', 'text'):
+            value = node[-1]
+            ratio = 100 if exact else wordRatio if len(value.split(' ')) == 1 else phraseRatio
+            return node + (ratio,)
+        return node
+    return ratios(parseQuery(query))
+
+# whether a plan has year or genre terms, which need MBdata
+def usesMBdata(plan):
+    kind = plan[0]
+    if kind in ('and', 'or'):
+        return any(usesMBdata(n) for n in plan[1])
+    if kind == 'not':
+        return usesMBdata(plan[1])
+    return kind in mbFields
+
+# how expensive a node is, so an AND narrows the songs with lookups before it scores anything
+def cost(node):
+    kind = node[0]
+    if kind in ('exact', 'year', 'genre'):
+        return 0
+    if kind == 'fuzzy':
+        return 1
+    if kind == 'text':
+        return 2
+    if kind == 'not':
+        return cost(node[1]) + 1
+    return max(cost(n) for n in node[1]) + 1
+
+# indexes over a collection, built the first time a query needs them and kept while the collection keeps its size
+fieldIndexes = {}
+
+def cachedIndex(songs, kind, key, build):
+    entry = fieldIndexes.get((id(songs), kind, key))
+    if entry and entry[0] is songs and entry[1] == len(songs):
+        return entry[2]
+    index = build()
+    fieldIndexes[(id(songs), kind, key)] = (songs, len(songs), index)
+    return index
+
+# the normalized names a field can be matched exactly against, every artist of a song counts
+def exactTexts(value):
+    values = value if isinstance(value, list) else [value]
+    return {normalize(v['name'] if isinstance(v, dict) and 'name' in v else v) for v in values if v}
+
+def buildExactIndex(songs, key):
+    index = {}
+    for position, song in enumerate(songs):
+        value = song.get(key)
+        if value:
+            for text in exactTexts(value):
+                index.setdefault(text, set()).add(position)
+    return index
+
+def buildVideoIndex(songs):
+    index = {}
+    for position, song in enumerate(songs):
+        if song.get('videoId'):
+            index.setdefault(song['videoId'], set()).add(position)
+    return index
+
+# run a compiled query over a collection and yield the matching songs in collection order
+# MBdata: videoId -> MusicBrainz info for year and genre terms, which match nothing without it
+# chunkSize: run over this many songs at a time, so the first matches come out before the whole collection is scored
+def runQuery(plan, songs, MBdata=None, chunkSize=None):
+    if not songs:
+        return
+    context = {'songs': songs, 'artistKey': 'artist' if any('artist' in s for s in songs[:50]) else 'artists',
+               'MBdata': MBdata, 'mbIndex': None, 'pools': {}}
+    chunkSize = chunkSize or len(songs)
+    for start in range(0, len(songs), chunkSize):
+        for position in sorted(matchPositions(plan, context, set(range(start, min(start + chunkSize, len(songs)))))):
+            yield songs[position]
+
+# the positions in within that match node
+def matchPositions(node, context, within):
+    kind = node[0]
+    if not within:
+        return set()
+    if kind == 'and':
+        for child in sorted(node[1], key=cost):
+            within = matchPositions(child, context, within)
+            if not within:
+                break
+        return within
+    if kind == 'or':
+        matched = set()
+        for child in sorted(node[1], key=cost):
+            # songs an earlier alternative matched do not need scoring again
+            matched |= matchPositions(child, context, within - matched)
+        return matched
+    if kind == 'not':
+        return within - matchPositions(node[1], context, within)
+    if kind == 'text':
+        matched = set()
+        for field in textFields:
+            matched |= fuzzyPositions(context, field, node[1], node[2], within - matched)
+        return matched
+    if kind == 'fuzzy':
+        return fuzzyPositions(context, node[1], node[2], node[3], within)
+    if kind == 'exact':
+        key = fieldKey(context, node[1])
+        index = cachedIndex(context['songs'], 'exact', key, lambda: buildExactIndex(context['songs'], key))
+        return index.get(normalize(node[2]), set()) & within
+    return mbPositions(node, context) & within
+
+# uploads call the artist field 'artist' and the other collections 'artists'
+def fieldKey(context, field):
+    return context['artistKey'] if field == 'artist' else field
+
+# score value against the songs in within that have the field and share a trigram with it
+def fuzzyPositions(context, field, value, ratio, within):
+    songs = context['songs']
+    key = fieldKey(context, field)
+    poolKey = (key, value)
+    if poolKey not in context['pools']:
+        index = cachedIndex(songs, 'grams', key, lambda: buildIndex(songs, key))
+        context['pools'][poolKey] = candidatePositions(index, value)
+    pool = context['pools'][poolKey]
+    positions = [p for p in sorted(within if pool is None else within & pool) if songs[p].get(key)]
+    if not positions:
+        return set()
+    accepted = checkSongs([songs[p] for p in positions], [(key, value, ratio)], True)
+    return {p for p, ok in zip(positions, accepted) if ok}
+
+# positions of the songs whose MusicBrainz year or genre matches
+def mbPositions(node, context):
+    if not context['MBdata']:
+        return set()
+    if context['mbIndex'] is None:
+        context['mbIndex'] = buildRuleIndex(context['MBdata'])
+    index = context['mbIndex']
+    if node[0] == 'year':
+        videoIds = set().union(*(index['years'].get(year, set()) for year in node[1]))
+    else:
+        videoIds = genreMatches(index, [node[1]])
+    byVideoId = cachedIndex(context['songs'], 'videoId', None, lambda: buildVideoIndex(context['songs']))
+    return set().union(*(byVideoId.get(v, set()) for v in videoIds))
@@ -0,0 +1,122 @@
+from scoring import fieldText, stringText, collectionText
+
+# compact records for the songs in the cached collections.
+# ytmusicapi gives every song thumbnails, flags and other fields nothing here reads, so a record keeps
+# only what matching, deleting and playlists use, and works out the rest once when it is built:
+# the processed texts filterSongs scores against, the duration in seconds and the add/remove tokens.
+# records still read like the song dicts (song['title'], song.get('artists'), 'album' in song.keys()),
+# so code that handles search results handles them too
+
+# the song dict keys that are kept, everything else is dropped
+songFields = ('videoId', 'entityId', 'setVideoId', 'title', 'artists', 'artist', 'album', 'duration', 'duration_seconds', 'feedbackTokens')
+
+# seconds from a YT Music duration string, M:SS or H:MM:SS
+def parseDuration(duration):
+    if not duration:
+        return None
+    try:
+        seconds = 0
+        for part in duration.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except ValueError:
+        return None
+
+# MM:SS, or H:MM:SS for anything an hour or longer
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(seconds or 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+# a small dict like an artist or album as a tuple of its items
+def packDict(value):
+    return tuple(value.items()) if isinstance(value, dict) else value
+
+def unpackDict(value):
+    return dict(value) if isinstance(value, tuple) else value
+
+# fieldText without its memo, which would keep the full response alive
+def textOf(value):
+    if not value:
+        return None
+    return collectionText(value) if isinstance(value, (list, dict)) else stringText(value)
+
+class SongRecord:
+    __slots__ = ('videoId', 'entityId', 'setVideoId', 'title', 'artists', 'album', 'duration', 'durationSeconds',
+                 'addToken', 'removeToken', 'artistKey', 'titleText', 'artistText', 'albumText')
+
+    def __init__(self, song):
+        self.videoId = song.get('videoId')
+        self.entityId = song.get('entityId')
+        self.setVideoId = song.get('setVideoId')
+        self.title = song.get('title')
+        # uploads name their artists 'artist', everything else 'artists'
+        self.artistKey = 'artist' if 'artist' in song else 'artists'
+        artists = song.get(self.artistKey)
+        album = song.get('album')
+        # nested dicts are kept as tuples and only turned back into dicts when they are read
+        self.artists = tuple(packDict(a) for a in artists) if isinstance(artists, list) else artists
+        self.album = packDict(album)
+        self.duration = song.get('duration')
+        self.durationSeconds = song.get('duration_seconds')
+        if self.durationSeconds is None:
+            self.durationSeconds = parseDuration(self.duration)
+        tokens = song.get('feedbackTokens') or {}
+        self.addToken = tokens.get('add')
+        self.removeToken = tokens.get('remove')
+        self.titleText = textOf(self.title)
+        self.artistText = textOf(artists)
+        self.albumText = textOf(album)
+
+    # the text keyCheck would score for a field, worked out when the record was built
+    def text(self, key):
+        if key == 'title':
+            return self.titleText
+        if key == self.artistKey:
+            return self.artistText
+        if key == 'album':
+            return self.albumText
+        return fieldText(self[key])
+
+    def __getitem__(self, key):
+        if key == 'feedbackTokens':
+            value = {'add': self.addToken, 'remove': self.removeToken} if self.addToken or self.removeToken else None
+        elif key == self.artistKey:
+            value = [unpackDict(a) for a in self.artists] if isinstance(self.artists, tuple) else self.artists
+        elif key == 'album':
+            value = unpackDict(self.album)
+        elif key == 'duration_seconds':
+            value = self.durationSeconds
+        elif key in songFields and key not in ('artist', 'artists'):
+            value = getattr(self, key)
+        else:
+            value = None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return [key for key in songFields if key in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return f'SongRecord({dict(self)!r})'
+
+# the stored form of a song: a dict of the kept fields, for the database and the delete journal
+def compactSong(song):
+    return {key: song[key] for key in songFields if key in song}
+
+# turn a collection of song dicts into records, records already built are kept
+def buildRecords(songs):
+    return [song if isinstance(song, SongRecord) else SongRecord(song) for song in songs or []]
@@ -0,0 +1,278 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from songRecord import compactSong
+
+# SQLite store for everything that used to live in cache.p and MBdata.p.
+# each collection, playlist and MusicBrainz entry is its own row, so saving a change
+# is a small transaction and a command only reads the tables it needs.
+
+schema = '''
+CREATE TABLE IF NOT EXISTS songs (
+    collection TEXT NOT NULL,
+    songKey TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    videoId TEXT,
+    entityId TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, songKey)
+);
+CREATE INDEX IF NOT EXISTS songsByPosition ON songs (collection, position);
+CREATE INDEX IF NOT EXISTS songsByVideoId ON songs (videoId);
+CREATE INDEX IF NOT EXISTS songsByEntityId ON songs (entityId);
+CREATE TABLE IF NOT EXISTS playlists (
+    playlistId TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    title TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlistTracks (
+    playlistId TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    videoId TEXT,
+    setVideoId TEXT,
+    PRIMARY KEY (playlistId, position)
+);
+CREATE INDEX IF NOT EXISTS playlistTracksByVideoId ON playlistTracks (videoId);
+CREATE TABLE IF NOT EXISTS mbdata (
+    videoId TEXT PRIMARY KEY,
+    duration INTEGER,
+    year INTEGER,
+    genres TEXT,
+    mbID TEXT
+);
+CREATE INDEX IF NOT EXISTS mbdataByMbID ON mbdata (mbID);
+CREATE TABLE IF NOT EXISTS mbmisses (
+    videoId TEXT PRIMARY KEY,
+    retryAfter REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mbcache (
+    kind TEXT NOT NULL,
+    mbID TEXT NOT NULL,
+    value TEXT,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (kind, mbID)
+);
+CREATE TABLE IF NOT EXISTS deleteJournal (
+    collection TEXT NOT NULL,
+    itemKey TEXT NOT NULL,
+    data TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (collection, itemKey)
+);
+CREATE TABLE IF NOT EXISTS uploadQueue (
+    filename TEXT PRIMARY KEY,
+    contentHash TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lastError TEXT,
+    updated REAL,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS uploadQueueByHash ON uploadQueue (contentHash);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# search and upload threads share the connection, so writes take this lock
+lock = threading.RLock()
+
+def openStore(dbFile):
+    conn = sqlite3.connect(str(dbFile), check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(schema)
+    return conn
+
+def getMeta(conn, name, default=None):
+    row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def setMeta(conn, name, value):
+    with lock, conn:
+        conn.execute('INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value', (name, json.dumps(value)))
+
+# songs are keyed by videoId, or entityId for the odd upload without one
+def songKey(song, position):
+    return song.get('videoId') or song.get('entityId') or f'#{position}'
+
+# return a collection in the order YT Music gave it, or None if it was never saved
+def loadCollection(conn, name):
+    if not getMeta(conn, f'collection:{name}'):
+        return None
+    rows = conn.execute('SELECT data FROM songs WHERE collection = ? ORDER BY position', (name,))
+    return [json.loads(data) for data, in rows]
+
+# upsert a collection and drop the songs that are no longer in it
+def saveCollection(conn, name, songs):
+    # only the fields that are used are stored, whether the songs are records or full responses
+    rows = [(name, songKey(song, i), i, song.get('videoId'), song.get('entityId'), json.dumps(compactSong(song))) for i, song in enumerate(songs or [])]
+    with lock, conn:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS keptKeys (songKey TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM keptKeys')
+        conn.executemany('INSERT OR IGNORE INTO keptKeys (songKey) VALUES (?)', [(r[1],) for r in rows])
+        conn.execute('DELETE FROM songs WHERE collection = ? AND songKey NOT IN (SELECT songKey FROM keptKeys)', (name,))
+        conn.executemany('''INSERT INTO songs (collection, songKey, position, videoId, entityId, data) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (collection, songKey) DO UPDATE SET position = excluded.position, videoId = excluded.videoId,
+            entityId = excluded.entityId, data = excluded.data
+            WHERE position != excluded.position OR data != excluded.data''', rows)
+        conn.execute('INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value', (f'collection:{name}', 'true'))
+
+# liked songs are a playlist, so the tracks go in songs and the rest of the response in meta
+def loadLikes(conn):
+    likes = getMeta(conn, 'likes')
+    if likes is None:
+        return None
+    likes['tracks'] = loadCollection(conn, 'likes') or []
+    return likes
+
+def saveLikes(conn, likes):
+    if likes is None:
+        return
+    saveCollection(conn, 'likes', likes['tracks'])
+    setMeta(conn, 'likes', {k: v for k, v in likes.items() if k != 'tracks'})
+
+def loadPlaylists(conn):
+    if not getMeta(conn, 'collection:playlists'):
+        return None
+    rows = conn.execute('SELECT data FROM playlists ORDER BY position')
+    return [json.loads(data) for data, in rows]
+
+def savePlaylists(conn, playlists):
+    rows = [(p['playlistId'], i, p.get('title'), json.dumps(p)) for i, p in enumerate(playlists or [])]
+    with lock, conn:
+        conn.execute('DELETE FROM playlists')
+        conn.executemany('INSERT OR REPLACE INTO playlists (playlistId, position, title, data) VALUES (?, ?, ?, ?)', rows)
+        # membership of deleted playlists is useless
+        conn.execute('DELETE FROM playlistTracks WHERE playlistId NOT IN (SELECT playlistId FROM playlists)')
+        conn.execute('INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value', ('collection:playlists', 'true'))
+
+# return the cached tracks of a playlist as dicts with videoId and setVideoId, and the track count
+# YT Music reported for them. both are None if the playlist was never cached
+def loadPlaylistTracks(conn, playlistId):
+    trackCount = getMeta(conn, f'playlist:{playlistId}')
+    if trackCount is None:
+        return None, None
+    rows = conn.execute('SELECT videoId, setVideoId FROM playlistTracks WHERE playlistId = ? ORDER BY position', (playlistId,))
+    return [{'videoId': videoId, 'setVideoId': setVideoId} for videoId, setVideoId in rows], trackCount
+
+def savePlaylistTracks(conn, playlistId, tracks, trackCount):
+    rows = [(playlistId, i, t.get('videoId'), t.get('setVideoId')) for i, t in enumerate(tracks)]
+    with lock, conn:
+        conn.execute('DELETE FROM playlistTracks WHERE playlistId = ?', (playlistId,))
+        conn.executemany('INSERT INTO playlistTracks (playlistId, position, videoId, setVideoId) VALUES (?, ?, ?, ?)', rows)
+        conn.execute('INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value', (f'playlist:{playlistId}', json.dumps(trackCount)))
+
+# forget a playlist's tracks so they are downloaded again next time
+def dropPlaylistTracks(conn, playlistId):
+    with lock, conn:
+        conn.execute('DELETE FROM playlistTracks WHERE playlistId = ?', (playlistId,))
+        conn.execute('DELETE FROM meta WHERE name = ?', (f'playlist:{playlistId}',))
+
+def loadMBdata(conn):
+    rows = conn.execute('SELECT videoId, duration, year, genres, mbID FROM mbdata')
+    return {videoId: {'duration': duration, 'year': year, 'genres': json.loads(genres), 'mbID': mbID} for videoId, duration, year, genres, mbID in rows}
+
+# changes are committed by commitStore so a batch of lookups is one transaction
+def putMBinfo(conn, videoId, info):
+    with lock:
+        conn.execute('INSERT OR REPLACE INTO mbdata (videoId, duration, year, genres, mbID) VALUES (?, ?, ?, ?, ?)',
+                     (videoId, info.get('duration'), info.get('year'), json.dumps(info.get('genres')), info.get('mbID')))
+        conn.execute('DELETE FROM mbmisses WHERE videoId = ?', (videoId,))
+
+def loadMBmisses(conn):
+    return dict(conn.execute('SELECT videoId, retryAfter FROM mbmisses'))
+
+def putMBmiss(conn, videoId, retryAfter):
+    with lock:
+        conn.execute('INSERT OR REPLACE INTO mbmisses (videoId, retryAfter) VALUES (?, ?)', (videoId, retryAfter))
+
+# MusicBrainz responses and results by kind and MBID, see mbCache
+# returns (True, value) for an entry younger than maxAge seconds and (False, None) otherwise
+def getMBcache(conn, kind, mbID, maxAge):
+    row = conn.execute('SELECT value, fetched FROM mbcache WHERE kind = ? AND mbID = ?', (kind, mbID)).fetchone()
+    if row is None or time.time() - row[1] > maxAge:
+        return False, None
+    return True, json.loads(row[0])
+
+def putMBcache(conn, kind, mbID, value):
+    with lock:
+        conn.execute('INSERT OR REPLACE INTO mbcache (kind, mbID, value, fetched) VALUES (?, ?, ?, ?)', (kind, mbID, json.dumps(value), time.time()))
+
+# forget every miss so the songs are looked up again, e.g. once a new offline index is imported
+def clearMBmisses(conn):
+    with lock, conn:
+        conn.execute('DELETE FROM mbmisses')
+
+# write the items a delete is going to remove, so it can be resumed after a crash
+# items is a list of (key, item) pairs
+def journalDeletes(conn, collection, items):
+    with lock, conn:
+        conn.executemany('INSERT OR IGNORE INTO deleteJournal (collection, itemKey, data) VALUES (?, ?, ?)',
+                         [(collection, key, json.dumps(item, default=compactSong)) for key, item in items])
+
+# return the (key, item) pairs still waiting to be deleted, or the collections with any waiting
+def pendingDeletes(conn, collection=None):
+    if collection is None:
+        return [c for c, in conn.execute('SELECT DISTINCT collection FROM deleteJournal WHERE done = 0')]
+    rows = conn.execute('SELECT itemKey, data FROM deleteJournal WHERE collection = ? AND done = 0 ORDER BY rowid', (collection,))
+    return [(key, json.loads(data)) for key, data in rows]
+
+def markDeleted(conn, collection, keys):
+    with lock, conn:
+        conn.executemany('UPDATE deleteJournal SET done = 1 WHERE collection = ? AND itemKey = ?', [(collection, key) for key in keys])
+
+def clearJournal(conn, collection):
+    with lock, conn:
+        conn.execute('DELETE FROM deleteJournal WHERE collection = ?', (collection,))
+
+# the audioHash a file was queued for upload with, or None. upload threads call this, so the read takes the lock too
+def uploadHash(conn, filename):
+    with lock:
+        row = conn.execute('SELECT contentHash FROM uploadQueue WHERE filename = ?', (filename,)).fetchone()
+    return row[0] if row else None
+
+def commitStore(conn):
+    if conn:
+        with lock:
+            conn.commit()
+
+def loadPickle(fileName):
+    try:
+        with open(fileName, 'rb') as f:
+            return pickle.load(f)
+    except Exception as err:
+        print(f'Problem loading {fileName}: {err}')
+        return None
+
+# one time import of the old pickle files. they are renamed afterwards so it only happens once
+def migratePickles(conn, cacheFile, MBfile, missFile, convert):
+    if cacheFile and cacheFile.exists():
+        cache = loadPickle(cacheFile)
+        if cache:
+            print('Moving cache file into the database')
+            uploads, library, playlists, likes = cache
+            saveCollection(conn, 'uploads', uploads)
+            saveCollection(conn, 'library', library)
+            savePlaylists(conn, playlists)
+            saveLikes(conn, likes)
+        os.replace(cacheFile, f'{cacheFile}.migrated')
+    if MBfile and MBfile.exists():
+        MBdata = loadPickle(MBfile)
+        if MBdata:
+            MBdata = convert(MBdata)
+            print(f'Moving {len(MBdata)} MusicBrainz entries into the database')
+            for videoId, info in MBdata.items():
+                putMBinfo(conn, videoId, info)
+        os.replace(MBfile, f'{MBfile}.migrated')
+    if missFile and missFile.exists():
+        misses = loadPickle(missFile)
+        for videoId, retryAfter in (misses or {}).items():
+            putMBmiss(conn, videoId, retryAfter)
+        os.replace(missFile, f'{missFile}.migrated')
+    commitStore(conn)
@@ -0,0 +1,41 @@
+import pytest
+from songQuery import parseQuery
+
+# queries for delete query and search with the plan parseQuery must give, or the error it must raise
+queryCases = [
+    (['queen'], ('text', 'queen')),
+    (['Under', 'Pressure'], ('text', 'Under Pressure')),
+    (['title:Song (Live)'], ('fuzzy', 'title', 'Song (Live)')),
+    (['(Live)'], ('text', 'Live')),
+    (['title:a:b'], ('fuzzy', 'title', 'a:b')),
+    (['url:http://example.com'], ('text', 'url:http://example.com')),
+    (['artist:=The Beatles'], ('exact', 'artist', 'The Beatles')),
+    (['genre:Trip Hop'], ('genre', 'trip hop')),
+    (['year:1990'], ('year', {1990})),
+    (['year:1990-1992'], ('year', {1990, 1991, 1992})),
+    (['year:1990,1995'], ('year', {1990, 1995})),
+    (['NOT', 'NOT', 'queen'], ('not', ('not', ('text', 'queen')))),
+    (['a', 'OR', 'b', 'c'], ('or', [('text', 'a'), ('text', 'b c')])),
+    (['a', 'OR', 'b', 'AND', 'NOT', 'c'], ('or', [('text', 'a'), ('and', [('text', 'b'), ('not', ('text', 'c'))])])),
+    (['(a', 'OR', 'b)', 'c'], ('and', [('or', [('text', 'a'), ('text', 'b')]), ('text', 'c')])),
+    (['artist:queen', 'NOT', '(live', 'OR', 'year:1986)'], ('and', [('fuzzy', 'artist', 'queen'), ('not', ('or', [('text', 'live'), ('year', {1986})]))])),
+    ([], 'the query is empty'),
+    (['(artist:a'], 'a parenthesis is not closed'),
+    (['b)'], 'unexpected )'),
+    (['AND'], 'unexpected AND'),
+    (['a', 'OR'], 'the query ends too early'),
+    (['NOT'], 'the query ends too early'),
+    (['title:'], 'title: needs a value'),
+    (['artist:='], 'artist:= needs a value'),
+    (['year:199x'], 'year:199x is not a year or a range of years'),
+    (['year:1990-'], 'year:1990- is not a year or a range of years'),
+]
+
+@pytest.mark.parametrize('query, expected', queryCases)
+def test_parseQuery(query, expected):
+    if isinstance(expected, str):
+        with pytest.raises(ValueError) as err:
+            parseQuery(query)
+        assert str(err.value) == expected
+    else:
+        assert parseQuery(query) == expected
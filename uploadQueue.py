@@ -0,0 +1,110 @@
+import json
+import queue
+import threading
+import time
+from rateLimiter import limitedCall
+from stateStore import lock
+from audioHash import audioHash
+
+# persistent queue of files to upload, drained by a pool of background threads.
+# every file is a row in the uploadQueue table, so uploads left over when a run stops
+# are picked up by the next one and a file with the same audio is only uploaded once, whatever its tags.
+
+workQueue = queue.Queue()
+workers = []
+settings = {}
+
+# start the upload threads and queue the uploads that an earlier run did not finish
+# onFinished(filename, uploaded) is called from an upload thread when a file is done or gave up
+def startUploads(conn, ytmusic, count, maxAttempts, onFinished=None):
+    if workers:
+        return
+    settings.update({'conn': conn, 'ytmusic': ytmusic, 'maxAttempts': maxAttempts, 'onFinished': onFinished})
+    leftover = leftoverUploads(conn, maxAttempts)
+    if leftover:
+        print(f'Resuming {len(leftover)} uploads from an earlier run')
+    for filename in leftover:
+        workQueue.put(filename)
+    while len(workers) < count:
+        worker = threading.Thread(target=uploadWorker, daemon=True)
+        worker.start()
+        workers.append(worker)
+
+# the files an earlier run left waiting in the queue, or that failed and have attempts left
+def leftoverUploads(conn, maxAttempts):
+    rows = conn.execute("SELECT filename FROM uploadQueue WHERE status = 'pending' OR (status = 'failed' AND attempts < ?) ORDER BY updated", (maxAttempts,))
+    return [filename for filename, in rows]
+
+# add a file to the queue and return the state its audio is in: 'uploaded' when it, or a file with the same audio,
+# was uploaded, and 'queued' when one of them is waiting or still has attempts left. a file whose uploads all
+# ran out of attempts, under this name or another, is queued again
+# fileHash: the audioHash of the file when the tag reader already worked it out
+def queueUpload(conn, filename, info=None, fileHash=None):
+    fileHash = fileHash or audioHash(filename)
+    maxAttempts = settings.get('maxAttempts', 5)
+    with lock, conn:
+        rows = conn.execute('SELECT filename, status, attempts FROM uploadQueue WHERE contentHash = ?', (fileHash,)).fetchall()
+        done = [r for r in rows if r[1] == 'done']
+        waiting = [r for r in rows if r[1] == 'pending' or (r[1] == 'failed' and r[2] < maxAttempts)]
+        if done or waiting:
+            state = 'uploaded' if done else 'queued'
+            other = (done or waiting)[0][0]
+            print(f'\t{filename} is already {state}' if other == filename else f'\t{filename} has the same content as {other}, which is already {state}')
+            return state
+        # a row for this name with other audio is a file that was replaced, so it is uploaded again
+        conn.execute('''INSERT INTO uploadQueue (filename, contentHash, status, attempts, updated, info) VALUES (?, ?, 'pending', 0, ?, ?)
+            ON CONFLICT (filename) DO UPDATE SET contentHash = excluded.contentHash, status = 'pending', attempts = 0, updated = excluded.updated, info = excluded.info''',
+                     (filename, fileHash, time.time(), json.dumps(info)))
+    workQueue.put(filename)
+    return 'queued'
+
+def setStatus(conn, filename, status, attempts, error=None):
+    with lock, conn:
+        conn.execute('UPDATE uploadQueue SET status = ?, attempts = ?, lastError = ?, updated = ? WHERE filename = ?',
+                     (status, attempts, error, time.time(), filename))
+
+def uploadFile(ytmusic, filename):
+    response = ytmusic.upload_song(filename)
+    if response != 'STATUS_SUCCEEDED':
+        # failed uploads come back as a response object, so turn them into an error with the status code
+        raise Exception(f'Server returned HTTP {getattr(response, "status_code", "???")}: upload failed')
+    return response
+
+# take files off the queue and upload them, backing off between attempts on the same file.
+# this loop is the only retry: limitedCall just keeps uploads under the shared rate limit, so every attempt is counted
+def uploadWorker():
+    while True:
+        filename = workQueue.get()
+        try:
+            conn = settings['conn']
+            with lock:
+                attempts = conn.execute('SELECT attempts FROM uploadQueue WHERE filename = ?', (filename,)).fetchone()[0]
+            uploaded = False
+            while attempts < settings['maxAttempts'] and not uploaded:
+                attempts += 1
+                try:
+                    limitedCall(uploadFile, settings['ytmusic'], filename, retries=0)
+                    uploaded = True
+                    setStatus(conn, filename, 'done', attempts)
+                    print(f'Uploaded {filename}')
+                except Exception as err:
+                    setStatus(conn, filename, 'failed', attempts, str(err))
+                    print(f'\tUpload {attempts} of {filename} failed: {err}')
+                    if attempts < settings['maxAttempts']:
+                        time.sleep(min(60, 2 ** attempts))
+            if settings['onFinished']:
+                settings['onFinished'](filename, uploaded)
+        except Exception as err:
+            print(f'\tUpload of {filename} stopped: {err}')
+        finally:
+            workQueue.task_done()
+
+# wait until every queued file is uploaded or has run out of attempts
+def finishUploads():
+    if workers and workQueue.unfinished_tasks:
+        print(f'Waiting for {workQueue.unfinished_tasks} uploads to finish')
+    workQueue.join()
+
+# return the number of files in each state
+def uploadSummary(conn):
+    return dict(conn.execute('SELECT status, COUNT(*) FROM uploadQueue GROUP BY status'))
@@ -1,28 +1,47 @@
 
 import pickle
 import json
-from ytmusicapi import YTMusic
 from datetime import datetime, timedelta
 from time import strftime, gmtime
-from fuzzywuzzy import fuzz, process
-import musicbrainzngs
 import sys
 import re
 import contextlib
+import hashlib
+from rateLimiter import limitedCall
+from searchCache import cachedResults, storeResults
+from metrics import count, stage
+from scoring import checkSongs
+from songRecord import parseDuration
+from mbIndex import indexCandidates
+from mbCache import cacheOldestDate, oldestYear
+from songQuery import compileQuery, runQuery
 
 # from recordingDate import recurse_relations
-from beetsplug.oldestdate import OldestDatePlugin
+# the oldest date plugin pulls in beets, so it is only created for the first MusicBrainz lookup
+# its lookups go through the persistent cache in mbCache
+od = None
 
-od = OldestDatePlugin()
+def oldestDatePlugin():
+    global od
+    if od is None:
+        from beetsplug.oldestdate import OldestDatePlugin
+        od = cacheOldestDate(OldestDatePlugin())
+    return od
 
 # perform the YT search and return the (hopefully) best result
-def searchYT(config, ytmusic, query, type, title, artist, duration, ignoredArtists, ignoredPhrases):
+# cache: search cache from loadSearchCache, results in it are scored again instead of searching
+def searchYT(config, ytmusic, query, type, title, artist, duration, ignoredArtists, ignoredPhrases, cache=None):
     wordRatio = config['DEFAULT'].getint('wordRatio')
     phraseRatio = config['DEFAULT'].getint('phraseRatio')
     aRatio = wordRatio if len(artist.split(' ')) == 1 else phraseRatio
     difference = 100
 
-    results = ytmusic.search(query, type, None, 50)
+    results = None
+    if cache is not None:
+        results = cachedResults(cache, query, type, config['DEFAULT'].getfloat('searchttl', 30), config['DEFAULT'].getfloat('searchmissttl', 3))
+        count('search_cache', result='miss' if results is None else 'hit')
+    if results is None:
+        results = limitedCall(ytmusic.search, query, type, None, 50)
     # make sure we got some results
     if results:
         # first make sure the matches are close
@@ -33,33 +52,40 @@ def searchYT(config, ytmusic, query, type, title, artist, duration, ignoredArtis
         if matchingSongs:
             # return the song with the duration that is closest to the original song
             for song in matchingSongs:
-                d = song.get('duration')
+                seconds = song.get('duration_seconds')
+                if seconds is None:
+                    seconds = parseDuration(song.get('duration'))
                 if any(x for x in song['artists'] for y in ignoredArtists if x['name'].find(y) != -1):
                     continue
                 if [x for x in ignoredPhrases if x in song.get('title')]:
                     print(f'Skipping result: {song.get("title")} by {song.get("artist")}')
                     continue
-                if not d:
+                if seconds is None:
                     continue
-                t = datetime.strptime(d, '%M:%S')
-                matchDuration = timedelta(minutes=t.minute, seconds=t.second)
-                diff = abs(matchDuration.seconds - duration)
+                diff = abs(seconds - duration)
                 if diff < difference:
                     difference = diff
                     currentSong = song
+    if cache is not None:
+        storeResults(cache, query, type, results, difference <= 10)
     # only return match with smallest duration difference
     return currentSong if difference <= 10 else False
 
 # return only songs that closely match the title and artist
+# every check is scored against the whole list in one batch by the scoring backend
 def filterSongs(songList, checks, key, oneResult, matchAll):
+    if not songList:
+        return False
+    matching = (element for element, ok in zip(songList, checkSongs(songList, checks, matchAll)) if ok if key in element)
     if oneResult:
-        return next((element for element in songList if keyCheck(checks, element, matchAll) if key in element), False)
+        return next(matching, False)
     else:
-        return [element for element in songList if keyCheck(checks, element, matchAll) if key in element] or False
+        return list(matching) or False
 
-# check multiple keys against values with given ratio.
-# return one boolean result with AND/OR depending on matchAll
+# check multiple keys against values with given ratio, one song at a time.
+# return one boolean result with AND/OR depending on matchAll. checkSongs makes the same decisions in batches
 def keyCheck(checks, item, matchAll):
+    from fuzzywuzzy import fuzz, process
     bools = []
     for key, value, ratio in checks:
         if not item.get(key):
@@ -74,6 +100,11 @@ def keyCheck(checks, item, matchAll):
             bools.append(fuzz.token_set_ratio(item[key].lower(), value.lower()) >= ratio)
     return all(bools) if matchAll else any(bools)
 
+# hash the tags that matching depends on, so a touched file with the same tags is not searched again
+def tagHash(artist, title, album, length):
+    tags = json.dumps([artist, title, album, round(length or 0)])
+    return hashlib.sha1(tags.encode('utf-8')).hexdigest()
+
 # check if the cache file is old
 def isOld(fileName):
     fileDate = datetime.fromtimestamp(fileName.stat().st_mtime)
@@ -95,54 +126,46 @@ def printSongs(header, songs):
     print(header)
     aKey = 'artist' if 'artist' in songs[0].keys() else 'artists'
     for song in songs:
-        title = song['title'] if 'title' in song.keys() else ''
-        artist = song[aKey][0]['name'] if aKey in song.keys() else 'Unknown'
-        album = song['album']['name'] if 'album' in song.keys() and song['album'] else 'Unknown'
-        print(f'"{title}" BY: {artist} ON: {album}')
+        print(songLine(song, aKey))
+
+def songLine(song, aKey):
+    title = song['title'] if 'title' in song.keys() else ''
+    artist = song[aKey][0]['name'] if aKey in song.keys() and song[aKey] else 'Unknown'
+    album = song['album']['name'] if 'album' in song.keys() and song['album'] else 'Unknown'
+    return f'"{title}" BY: {artist} ON: {album}'
+
+# run a user query over a collection, see songQuery for the query language
+# exact: every fuzzy term has to match exactly (the -e option). MBdata: needed for year and genre terms
+# returns the matching songs in collection order, or an empty list when the query is not valid
+def performQuery(config, query, collection, exact, MBdata=None):
+    try:
+        plan = compileQuery(query, config['DEFAULT'].getint('wordRatio'), config['DEFAULT'].getint('phraseRatio'), exact)
+    except ValueError as err:
+        print(f'Invalid query: {err}')
+        return []
+    return list(runQuery(plan, collection, MBdata))
 
-# process user query string and perform a fuzzy match unless exact is True
-def performQuery(config, query, collection, exact):
+# get the release year and the genres for one song from MusicBrainz
+# index: the offline index from mbIndex, the web service is only asked about songs it does not have
+def getMBinfo(config, title, artist, index=None):
     wordRatio = config['DEFAULT'].getint('wordRatio')
     phraseRatio = config['DEFAULT'].getint('phraseRatio')
-    aKey = 'artist' if 'artist' in collection[0].keys() else 'artists'
-    checks = []
-    matchAll = True
-
-    # field restricted matching
-    if any(':' in s for s in query):
-        for i in query:
-            key, value = i.split(':')
-            key = aKey if key == 'artist' else key
-            # stricter matching for one word queries
-            ratio = wordRatio if len(value.split(' ')) == 1 else phraseRatio
-            if exact:
-                ratio = 100
-            checks.append((key, value, ratio))
-    # simple match string
-    else:
-        matchAll = False
-        value = ' '.join(query)
-        # stricter matching for one word queries
-        ratio = wordRatio if len(query) == 1 else phraseRatio
-        if exact:
-            ratio = 100
-        for key in ['title', aKey, 'album']:
-            checks.append((key, value, ratio))
+    relation_type = None
+    aRatio = wordRatio if len(artist.split(' ')) == 1 else phraseRatio
+    # set oldest release year to 0 so it is an int for matching later
 
-    return filterSongs(collection, checks, 'title', False, matchAll)
+    if index is not None:
+        info = indexMBinfo(index, title, artist, [('title', title, phraseRatio), ('artist-credit', artist, aRatio)])
+        count('mb_index', result='hit' if info else 'miss')
+        if info or not config['DEFAULT'].getboolean('mbfallback', True):
+            return info
 
-# get the release year and the genres for one song from MusicBrainz
-def getMBinfo(config, title, artist):
+    import musicbrainzngs
+    od = oldestDatePlugin()
     od.config['approach'] = config['DEFAULT'].get('approach', 'hybrid')
     od.config['musicbrainz']['host'] = config['DEFAULT']['mbhost']
     od.config['musicbrainz']['ratelimit'] = config['DEFAULT'].getfloat('mbrateLimit')
 
-    wordRatio = config['DEFAULT'].getint('wordRatio')
-    phraseRatio = config['DEFAULT'].getint('phraseRatio')
-    relation_type = None
-    aRatio = wordRatio if len(artist.split(' ')) == 1 else phraseRatio
-    # set oldest release year to 0 so it is an int for matching later
-
     results = musicbrainzngs.search_recordings(limit=25, artist=artist,recording=title)['recording-list']
 
     # return the first match that definitely has the same artist and title
@@ -150,7 +173,8 @@ def getMBinfo(config, title, artist):
     if not song:
         return None
     # get the earliest release date for a song instead of its re-release date
-    oldest_release = od._get_oldest_date(song['id'], None)
+    with stage('oldest_date'):
+        oldestRelease = oldestYear(od, song['id'])
     # track itself contains genres or folksonomy tags as MusicBrainz calls them
     if 'tag-list' in song:
         tagList = [t['name'] for t in song['tag-list']]
@@ -160,7 +184,18 @@ def getMBinfo(config, title, artist):
     # give up already
     else:
         tagList = []
-    return {'duration': song['length'], 'year': (oldest_release.y if oldest_release else None), 'genres': tagList, 'mbID': song['id']}
+    return {'duration': song['length'], 'year': oldestRelease, 'genres': tagList, 'mbID': song['id']}
+
+# getMBinfo from the offline index. the year is the earliest of every recording with the same artist and title,
+# like the oldest date plugin finds it, and the genres are the first match's, or all of theirs if it has none
+def indexMBinfo(index, title, artist, checks):
+    matches = filterSongs(indexCandidates(index, title, artist), checks, 'title', False, True)
+    if not matches:
+        return None
+    song = matches[0]
+    years = [m['year'] for m in matches if m['year']]
+    genres = song['genres'] or list(dict.fromkeys(g for m in matches for g in m['genres']))
+    return {'duration': song['length'], 'year': min(years) if years else None, 'genres': genres, 'mbID': song['id']}
 
 
 # return the set of rules for the playlist
@@ -180,7 +215,7 @@ def getRule(ruleSection):
             start, end = (year, None)
         # convert start and if present end to a list of years in the range
         if start:
-            rule['year'] = list(range(int(start), int(end) + 1)) if end else list(int(start))
+            rule['year'] = list(range(int(start), int(end) + 1)) if end else [int(start)]
     if 'genre' in ruleSection.keys():
         temp = json.loads(ruleSection['genre'])
         rule['genre'] = [r for r in temp if not r.startswith('^')]
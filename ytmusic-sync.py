@@ -7,25 +7,39 @@ import os, subprocess, platform
 import pathlib
 import json
 import pickle
-from phrydy import MediaFileExtended
+import multiprocessing
+import threading
+import itertools
 import configparser
-import ytmusicapi
-from ytmusicapi import YTMusic
 from datetime import datetime, timedelta
-from time import strftime, gmtime, sleep
+from time import strftime, gmtime
 from appdirs import *
-from tqdm import tqdm
 import re
 import csv
-import musicbrainzngs
+import time
 
 from utils import *
 from fileOperations import *
+from matchIndex import buildIndex, candidates
+from rateLimiter import configureLimiter, limitedCall, runBounded, httpStatus, pooledSession
+from ruleEngine import compileRules
+from reconcile import buildIndexes, planLikes, planDuplicateUploads, planDeleteAll, groupPlan
+from uploadQueue import startUploads, queueUpload, finishUploads, uploadSummary, leftoverUploads
+from metrics import instrument, count, stage, writeMetrics
+from scoring import configureScoring
+from songRecord import buildRecords, formatDuration
+from playlistFiles import findPlaylists, readPlaylist, playlistName
+from mbIndex import openMBindex, importDumps
+from mbCache import configureMBcache
+from songQuery import compileQuery, runQuery, usesMBdata
+from fileWatcher import openWatcher, watchBatches
 
 
 appName = 'YT Music Sync'
 appVer = '0.1'
 YTDelay = None
+maxConcurrency = None
+scanWorkers = None
 wordRatio = None
 phraseRatio = None
 userDir = pathlib.Path(user_data_dir(appName, ''))
@@ -34,18 +48,44 @@ configPath = None
 cacheFile = None
 authFile = None
 MBfile = None
+mbIndexFile = None
+mbIndex = None
+missFile = None
+dbFile = None
+conn = None
+manifestFile = None
+searchFile = None
+metricsFile = None
+promFile = None
 ytmusic = None
 uploadSongs = False
-notFound = []
+# songs for missing.csv by filename, so a file that is seen again, like in a watch session, is written once
+notFound = {}
 ignoredArtists = []
 ignoredPhrases = []
 firstArg = None
-playlistItems = set()
+fullSync = False
+# videoId, or False, for every file resolved in this run, so a file shared by many playlists is matched once
+resolvedFiles = {}
 MBdata = []
+uploads = []
+library = []
+playlists = []
+likes = {'tracks': []}
+libraryIndex = None
+uploadsIndex = None
+knownIds = set()
+uploadLock = threading.Lock()
+# upload threads finish manifest entries and report missing songs while the scan is adding them
+manifestLock = threading.RLock()
+manifest = {}
+searchCache = None
 commandHelp = [
 'Available commands are:',
 '-d directory\tScans all subdirectories under directory for music files and adds them to library',
+'watch [directory]\tKeeps adding new and changed music files from the musicroots folders in config, or the given ones, until stopped',
 '-p playlist\tAdds all playlist items to library and to the named playlist',
+'\t\tTakes any number of M3U, M3U8 or PLS files, or directories of them',
 'likes\tAdds all liked songs to your library',
 'smart\tCreates and updates playlists by rules set in config file',
 'config\tPerform config file operations',
@@ -53,6 +93,10 @@ commandHelp = [
 '\tedit\tOpens the config file for editing in your default editor',
 '\treset\tResets the config file to default settings',
 'resetAuth\tUse to delete auth file and paste new credentials',
+'upload\tFinishes the uploads an earlier run left in the upload queue',
+'mbimport dump\tBuilds the offline MusicBrainz index from JSON or TSV dumps',
+'search query\tLists the songs in uploads, library and likes that match a query, see delete query',
+'--full\tDownload every collection from YT Music instead of only the newest songs',
 'delete\t\tDeletes specified items'
 ]
 deleteHelp = [
@@ -62,81 +106,227 @@ deleteHelp = [
 'library\t\tdeletes all songs from your library',
 'likes\t\tremove all songs from your likes',
 'playlist\tremoves all playlists or specified playlist by name',
+'duplicates\tremoves uploads that are also in your library as YT Music songs',
 'query\t\tdelete items that match a query from uploads, library, and likes',
 '\t\t\t-e option will perform and exact search instead of a fuzzy search',
-'\t\t\tA string of words will match ALL words',
+'\t\t\tA string of words will match ALL words in the title, artist or album',
 '\t\t\tartist:"query" will only search artist for "query"',
 '\t\t\ttitle:"query" will only search song title for "query"',
-'\t\t\talbum:"query" will only search album for "query"'
+'\t\t\talbum:"query" will only search album for "query"',
+'\t\t\tartist:="query" only matches songs whose artist is exactly "query"',
+'\t\t\tyear:1990, year:1990-1999 and genre:rock match MusicBrainz data from smart playlists',
+'\t\t\tAND, OR, NOT and parentheses combine them, like artist:queen NOT (live OR year:1986)'
 ]
 
-musicbrainzngs.set_useragent(
-    'Youtube Music Sync',
-    appVer,
-    ''
-)
+# what each command needs loaded before it runs. commands not listed (help, config, resetAuth) need nothing
+#   ytmusic: an authenticated client, store: the state database
+#   uploads, library, likes, playlists: the collections loadCache brings up to date
+#   scan: the scan manifest and search cache, musicbrainz: the MusicBrainz client
+# delete always loads every collection, since it keeps them in step with what was deleted
+# search only reads, so it uses the collections as the last run saved them and needs no client
+commandNeeds = {
+    '-d': {'ytmusic', 'store', 'uploads', 'library', 'likes', 'scan'},
+    'watch': {'ytmusic', 'store', 'uploads', 'library', 'likes', 'scan'},
+    '-p': {'ytmusic', 'store', 'uploads', 'library', 'likes', 'playlists', 'scan'},
+    'likes': {'ytmusic', 'store', 'uploads', 'library', 'likes'},
+    'smart': {'ytmusic', 'store', 'uploads', 'library', 'likes', 'playlists', 'musicbrainz'},
+    'delete': {'ytmusic', 'store', 'uploads', 'library', 'likes', 'playlists'},
+    'upload': {'ytmusic', 'store', 'scan'},
+    'mbimport': {'store'},
+    'search': {'store', 'uploads', 'library', 'likes'}
+}
 
 # perform add to library or uploads for each file
 # filename: the full path to the file
-def processFile(filename):
+# track: tags already read by readTags, otherwise they are read here
+def processFile(filename, track=None):
     global notFound
     tRatio = phraseRatio
 
     try:
-        track = MediaFileExtended(filename)
-    except Exception as e:
+        stat = os.stat(filename)
+    except OSError:
         print(f'\tCould not process file ({filename})')
         return False
+    # unchanged files are resolved from the scan manifest without reading their tags
+    entry = manifest.get(filename)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        result = manifestResult(filename, entry)
+        if result is not None:
+            if entry['status'] == 'missing':
+                addNotFound(entry['info'])
+            return result
+
+    if track is None:
+        with stage('tags'):
+            filename, track = readTags(filename)
     # skip damaged or non-audio file
     if not track:
+        print(f'\tCould not process file ({filename})')
+        recordFile(filename, stat, None, 'skipped')
         return False
-    tmpArtist = track.artist
+    tmpArtist = track['artist']
     artist = tmpArtist.split(' feat.')[0] if tmpArtist else '' # truncate artist at feat. so only one artists name is present
-    album = track.album
-    title = track.title
+    album = track['album']
+    title = track['title']
     # get duration as a familiar M:S formated string
-    duration = strftime("%M:%S", gmtime(track.length))
+    duration = formatDuration(track['length'])
+    info = {'title':title,'artist':artist,'duration':duration,'filename':filename}
+    tags = tagHash(artist, title, album, track['length'])
+
+    # the file was touched but its tags are the same, so the old result still applies
+    if entry and entry['tagHash'] == tags:
+        recordFile(filename, stat, tags, entry['status'], entry['videoId'], entry['info'], entry.get('audioHash'))
+        # the new entry, which manifestResult updates when an uploaded song has turned up
+        result = manifestResult(filename, manifest[filename])
+        if result is not None:
+            if entry['status'] == 'missing':
+                addNotFound(entry['info'])
+            return result
 
     # skip songs missing artist or title
     if not artist or not title:
-        notFound.append({'title':title,'artist':artist,'duration':duration,'filename':filename})
+        addNotFound(info)
+        recordFile(filename, stat, tags, 'missing', None, info)
         return False
 
     aRatio = wordRatio if len(artist.split(' ')) == 1 else phraseRatio
-    # check library for song
-    libraryResult = filterSongs(library, [('title', title, tRatio), ('artists', artist, aRatio)], 'title', True, True)
+    with stage('match'):
+        # check library for song
+        libraryResult = filterSongs(candidates(libraryIndex, library, title), [('title', title, tRatio), ('artists', artist, aRatio)], 'title', True, True)
+        # check uploads for song
+        uploadsResult = not libraryResult and filterSongs(candidates(uploadsIndex, uploads, title), [('title', title, tRatio), ('artist', artist, aRatio)], 'title', True, True)
     if libraryResult:
         print(f'song "{title}" by {artist}: {duration} is already in your library')
+        recordFile(filename, stat, tags, 'found', libraryResult['videoId'], info)
         return libraryResult['videoId']
-    # check uploads for song
-    uploadsResult = filterSongs(uploads, [('title', title, tRatio), ('artist', artist, aRatio)], 'title', True, True)
     if uploadsResult:
         print(f'song "{title}" by {artist}: {duration} is already uploaded')
+        recordFile(filename, stat, tags, 'found', uploadsResult['videoId'], info)
         return uploadsResult['videoId']
     # search YT music for the song
-    song = searchYT(config, ytmusic, f'{artist} - {title}', 'songs', title, artist, track.length, ignoredArtists, ignoredPhrases)
+    with stage('search'):
+        song = searchYT(config, ytmusic, f'{artist} - {title}', 'songs', title, artist, track['length'], ignoredArtists, ignoredPhrases, searchCache)
 
     # if the song was found
     if song:
         print(f'Adding song "{song["title"]}" by {song["artists"][0]["name"]}: {song["duration"]} for "{title}" by {artist}: {duration} to library')
         # some songs are missing the necessary information to add them to your library
         # if the song has the info, add to library, and just like it if not
-        if 'feedbackTokens' in song.keys():
-            makeCall('library', song, False)
-        else:
-            makeCall('likes', song, False)
+        with stage('add'):
+            if 'feedbackTokens' in song.keys():
+                makeCall('library', song, False)
+            else:
+                makeCall('likes', song, False)
+        recordFile(filename, stat, tags, 'found', song['videoId'], info)
+        knownIds.add(song['videoId'])
         return song['videoId']
-    # song not found on YT music, so upload it
+    # song not found on YT music, so queue it for the upload threads
     elif uploadSongs:
-        print(f'Uploading song "{title}" by {artist}: {duration}')
-        response = makeCall('uploads', filename, False)
-        print(response)
+        print(f'Queueing song "{title}" by {artist}: {duration} for upload')
+        startUploadWorkers()
+        # a file with the same audio as one that is already queued or uploaded shares its state
+        recordFile(filename, stat, tags, queueUpload(conn, filename, info, track.get('audioHash')), None, info, track.get('audioHash'))
     # user does not want to upload the song
     else:
         print(f'MISSING "{title}" by {artist}: {duration}')
-        notFound.append({'title':title,'artist':artist,'duration':duration,'filename':filename})
+        addNotFound(info)
+        recordFile(filename, stat, tags, 'missing', None, info)
     return False
 
+# remember how a file was resolved so the next scan can skip it while it is unchanged
+def recordFile(filename, stat, tags, status, videoId=None, info=None, audioHash=None):
+    with manifestLock:
+        manifest[filename] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'tagHash': tags, 'status': status, 'videoId': videoId, 'info': info, 'audioHash': audioHash}
+        # a song that was missing earlier in a watch session and has been found since
+        if status != 'missing':
+            notFound.pop(filename, None)
+    count('files', status=status)
+
+# add a song to missing.csv
+def addNotFound(info):
+    with manifestLock:
+        notFound[info['filename']] = info
+
+# start the upload threads once, they also pick up uploads left over from earlier runs
+def startUploadWorkers():
+    with uploadLock:
+        startUploads(conn, ytmusic, config['DEFAULT'].getint('uploadworkers', 2), config['DEFAULT'].getint('uploadattempts', 5), uploadFinished)
+
+# called by an upload thread when a queued file was uploaded or ran out of attempts
+# copies of the file that shared its queued state, see shareResult and queueUpload, are finished with it
+def uploadFinished(filename, uploaded):
+    fileHash = uploadHash(conn, filename)
+    with manifestLock:
+        for name, entry in manifest.items():
+            if name != filename and not (fileHash and entry.get('audioHash') == fileHash and entry['status'] == 'queued'):
+                continue
+            entry['status'] = 'uploaded' if uploaded else 'missing'
+            if not uploaded and entry['info']:
+                addNotFound(entry['info'])
+
+# finish the uploads left in the queue by an earlier run
+def drainUploads():
+    startUploadWorkers()
+    finishUploads()
+    print(', '.join(f'{count} {status}' for status, count in uploadSummary(conn).items()) or 'Upload queue is empty')
+
+# the manifest entry for a file that has not changed since it was resolved, or None
+def unchangedEntry(filename):
+    entry = manifest.get(filename)
+    if not entry:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+        return None
+    return entry
+
+# the files the manifest does not resolve yet, found without reading their tags
+# songs the manifest still knows are missing are added to missing.csv here, as they never reach processFile
+def unresolvedFiles(paths):
+    for filename in paths:
+        entry = unchangedEntry(filename)
+        if entry is None or manifestResult(filename, entry) is None:
+            yield filename
+        elif entry['status'] == 'missing':
+            addNotFound(entry['info'])
+
+# return the stored result for an unchanged file, or None if it has to be processed again
+def manifestResult(filename, entry):
+    status = entry['status']
+    result = None
+    # make sure the song was not removed from YT Music since it was matched
+    if status == 'found' and entry['videoId'] in knownIds:
+        result = entry['videoId']
+    # an uploaded song only has a videoId once YT Music lists it in uploads, so it is looked for there every run
+    elif status in ('uploaded', 'queued'):
+        videoId = uploadedVideoId(entry['info'])
+        if videoId:
+            entry['status'] = status = 'found'
+            entry['videoId'] = result = videoId
+        # queued files are retried by the upload queue itself, uploaded ones without tags to look for are processed again
+        elif status == 'queued' or entry['info']:
+            result = False
+    elif status == 'skipped':
+        result = False
+    # missing songs are tried again once uploading has been turned on
+    elif status == 'missing' and not uploadSongs:
+        result = False
+    if result is not None:
+        count('manifest_hits', status=status)
+    return result
+
+# the videoId of an uploaded file that YT Music now lists in uploads, matched by the tags kept in its manifest entry
+def uploadedVideoId(info):
+    if not info or not info.get('artist') or not info.get('title'):
+        return None
+    aRatio = wordRatio if len(info['artist'].split(' ')) == 1 else phraseRatio
+    song = filterSongs(candidates(uploadsIndex, uploads, info['title']), [('title', info['title'], phraseRatio), ('artist', info['artist'], aRatio)], 'title', True, True)
+    return song['videoId'] if song and song.get('videoId') in knownIds else None
+
 # load options from the ini file or create it with defaults if it doesn't exist
 def loadConfig():
     global config
@@ -144,56 +334,110 @@ def loadConfig():
     global ignoredPhrases
     global cacheFile
     global firstArg
+    global fullSync
     global uploadSongs
     global authFile
     global MBfile
+    global mbIndexFile
+    global missFile
+    global dbFile
+    global manifestFile
+    global searchFile
+    global metricsFile
+    global promFile
     global configPath
     global wordRatio
     global phraseRatio
     global YTDelay
+    global maxConcurrency
+    global scanWorkers
 
     if not userDir.exists():
         os.makedirs(userDir)
     configPath = userDir / 'config.ini'
+    # --full can go anywhere on the command line
+    if '--full' in sys.argv:
+        fullSync = True
+        sys.argv.remove('--full')
     if len(sys.argv) > 1:
         firstArg = sys.argv[1]
 
     if configPath.exists():
         print('loading config from file')
         config.read(configPath)
-        # if the ini file contains a relative path for the cache file use userDir as a base
-        cacheFile = pathlib.Path(config['DEFAULT']['cachefile']) if config['DEFAULT']['cachefile'].startswith('/') else userDir / config['DEFAULT']['cachefile']
-        authFile = pathlib.Path(config['DEFAULT']['authfile']) if config['DEFAULT']['authfile'].startswith('/') else userDir / config['DEFAULT']['authfile']
-        MBfile = pathlib.Path(config['DEFAULT']['mbfile']) if config['DEFAULT']['mbfile'].startswith('/') else userDir / config['DEFAULT']['mbfile']
+        # if the ini file contains a relative path for a file use userDir as a base
+        authFile = userFile('authfile', 'headers_auth.json')
+        dbFile = userFile('dbfile', 'state.db')
+        manifestFile = userFile('manifestfile', 'manifest.p')
+        searchFile = userFile('searchcachefile', 'searchcache.p')
+        # an empty file name turns that metrics file off
+        metricsFile = userFile('metricsfile', 'metrics.json') if config['DEFAULT'].get('metricsfile', 'metrics.json') else None
+        promFile = userFile('promfile', 'metrics.prom') if config['DEFAULT'].get('promfile', 'metrics.prom') else None
+        # pickle files from older versions, moved into the database on first run
+        cacheFile = userFile('cachefile', 'cache.p')
+        MBfile = userFile('mbfile', 'MBdata.p')
+        mbIndexFile = userFile('mbindexfile', 'mbindex.db')
+        missFile = userFile('mbmissfile', 'MBmisses.p')
         ignoredArtists = json.loads(config.get('DEFAULT', 'ignoredartists'))
         ignoredPhrases = json.loads(config.get('DEFAULT', 'ignoredphrases'))
         uploadSongs = config['DEFAULT'].getboolean('uploadsongs')
         wordRatio = config['DEFAULT'].getint('wordRatio')
         phraseRatio = config['DEFAULT'].getint('phraseRatio')
         YTDelay = config['DEFAULT'].getfloat('YTDelay')
-        musicbrainzngs.set_hostname(config['DEFAULT']['mbhost'])
-        musicbrainzngs.set_rate_limit(1, config['DEFAULT'].getfloat('mbrateLimit'))
+        maxConcurrency = config['DEFAULT'].getint('maxconcurrency', 4)
+        scanWorkers = config['DEFAULT'].getint('scanworkers', 0) or os.cpu_count()
     else:
         config['DEFAULT'] = {}
-        config['DEFAULT']['cachefile'] = 'cache.p'
         config['DEFAULT']['authfile'] = 'headers_auth.json'
-        config['DEFAULT']['mbfile'] = 'MBdata.p'
+        config['DEFAULT']['dbfile'] = 'state.db'
+        config['DEFAULT']['mbretrydays'] = '30'
+        config['DEFAULT']['mbindexfile'] = 'mbindex.db'
+        config['DEFAULT']['mbcachedays'] = '90'
+        config['DEFAULT']['mbfallback'] = 'yes'
+        config['DEFAULT']['mbcheckpoint'] = '100'
+        config['DEFAULT']['mbcheckpointseconds'] = '300'
+        config['DEFAULT']['manifestfile'] = 'manifest.p'
+        config['DEFAULT']['searchcachefile'] = 'searchcache.p'
+        config['DEFAULT']['searchttl'] = '30'
+        config['DEFAULT']['searchmissttl'] = '3'
+        config['DEFAULT']['metricsfile'] = 'metrics.json'
+        config['DEFAULT']['promfile'] = 'metrics.prom'
+        config['DEFAULT']['fullsyncdays'] = '7'
         config['DEFAULT']['uploadsongs'] = 'no'
+        config['DEFAULT']['uploadworkers'] = '2'
+        config['DEFAULT']['uploadattempts'] = '5'
         config['DEFAULT']['mbhost'] = 'musicbrainz.org'
         config['DEFAULT']['mbrateLimit'] = '1'
         config['DEFAULT']['wordRatio'] = '96'
         config['DEFAULT']['phraseRatio'] = '89'
         config['DEFAULT']['YTDelay'] = '0.1'
+        config['DEFAULT']['maxconcurrency'] = '4'
+        config['DEFAULT']['scanworkers'] = '0'
+        config['DEFAULT']['musicroots'] = json.dumps([])
+        config['DEFAULT']['watchdebounce'] = '2'
+        config['DEFAULT']['watchpoll'] = '30'
+        config['DEFAULT']['watchrefresh'] = '60'
+        config['DEFAULT']['scoringbackend'] = 'auto'
+        config['DEFAULT']['scoreworkers'] = '0'
         config['DEFAULT']['approach'] = 'hybrid'
         config['DEFAULT']['ignoredartists'] = json.dumps(['karaoke', 'in the style of', 'tribute'])
         config['DEFAULT']['ignoredphrases'] = json.dumps(['karaoke', 'in the style of', 'tribute'])
         config['DEFAULT']['ignoredgenres'] = json.dumps(['^punk', '^grunge' ,'^hard', '^metal', '^classical', '^alternative', '^rap', '^hip hop', '^holiday', '^christmas'])
         cacheFile = userDir / 'cache.p'
         authFile = userDir / 'headers_auth.json'
+        dbFile = userDir / 'state.db'
         MBfile = userDir / 'MBdata.p'
+        mbIndexFile = userDir / 'mbindex.db'
+        missFile = userDir / 'MBmisses.p'
+        manifestFile = userDir / 'manifest.p'
+        searchFile = userDir / 'searchcache.p'
+        metricsFile = userDir / 'metrics.json'
+        promFile = userDir / 'metrics.prom'
         wordRatio = 96
         phraseRatio = 89
         YTDelay = 0.1
+        maxConcurrency = 4
+        scanWorkers = os.cpu_count()
         ignoredArtists = ['karaoke', 'in the style of', 'tribute']
         ignoredPhrases = ['karaoke', 'in the style of', 'tribute']
         print('Writing config file')
@@ -202,14 +446,24 @@ def loadConfig():
                 print(f'Problem saving config file: {err}')
             else:
                 config.write(configFile)
+    # every request to YT Music shares one rate limit, whichever thread sends it
+    configureLimiter(YTDelay, maxConcurrency)
+    configureScoring(config['DEFAULT'].get('scoringbackend', 'auto'), config['DEFAULT'].getint('scoreworkers', 0))
+
+# return the path for a file option, relative paths are under userDir
+def userFile(key, default):
+    name = config['DEFAULT'].get(key, default)
+    return pathlib.Path(name) if name.startswith('/') else userDir / name
 
 def authenticate(reset = False):
     global ytmusic
+    import ytmusicapi
 
     if reset:
         os.remove(authFile)
     if authFile.exists():
-        ytmusic = YTMusic(str(authFile))
+        # every api call is timed for the run metrics, and the threads share a pool of keep-alive connections
+        ytmusic = instrument(ytmusicapi.YTMusic(str(authFile), requests_session=pooledSession(maxConcurrency)), 'ytmusic')
     else:
         ytmusicapi.setup(filepath=str(authFile))
         exit(0)
@@ -217,21 +471,22 @@ def authenticate(reset = False):
 def myExceptHandler(exctype, value, traceback):
     # print 5 bells to signify error
     print('\a\a\a\a\a')
-    saveCache(cacheFile, MBfile, MBdata, [uploads, library, playlists, likes])
+    saveState()
+    writeMetrics(metricsFile, promFile, command=firstArg or 'help', outcome='failed')
     sys.__excepthook__(exctype, value, traceback)
 
 def deletePlaylist(name):
     if not name:
         if proceed('This will delete ALL playlists from YT Music. Are you sure?'):
-            for pls in playlists:
-                ytmusic.delete_playlist(pls['playlistId'])
-                sleep(YTDelay)
+            journalDeletes(conn, 'playlists', [(p['playlistId'], p) for p in playlists])
+            runDeletes('playlists')
     else:
         name = ' '.join(name)
         if proceed(f'Are you sure you want to delete playlist "{name}"?'):
-            pId = next((p['playlistId'] for p in playlists if p['title'] == name), None)
-            if pId:
-                ytmusic.delete_playlist(pId)
+            pls = next((p for p in playlists if p['title'] == name), None)
+            if pls:
+                journalDeletes(conn, 'playlists', [(pls['playlistId'], pls)])
+                runDeletes('playlists')
             else:
                 print(f'Playlist "{name}" not found. Make sure it was typed correctly.')
                 print('The playlists on YT Music are:')
@@ -239,39 +494,121 @@ def deletePlaylist(name):
                     print(f'{pls["title"]}')
 
 # delete songs matching query or all songs from chosen collection
-def deleteFrom(cName, collection, query):
-    exact = False
+# songMB: the MusicBrainz data for year and genre terms, see queryMBdata
+def deleteFrom(cName, collection, query, songMB=None):
     if not query:
         if proceed(f'This will delete ALL {cName} from YT Music (long process). Are you sure?'):
-            for song in tqdm(collection):
-                makeCall(cName, song, True)
-                sleep(YTDelay)
+            journalSongs(cName, collection)
+            runDeletes(cName)
     else:
-        if '-e' in query:
-            exact = True
-            query.remove('-e')
-        results = performQuery(config, query, collection, exact)
+        # the query is shared by every collection, so it is not changed here
+        exact = '-e' in query
+        query = [q for q in query if q != '-e']
+        results = performQuery(config, query, collection, exact, songMB)
         if not results:
             return
         printSongs(f'\n\tFound {len(results)} songs from {cName}:', results)
         if proceed('Are you sure you want to delete these songs?'):
-            for song in tqdm(results):
-                makeCall(cName, song, True)
-                sleep(YTDelay)
+            journalSongs(cName, results)
+            runDeletes(cName)
+
+# the key a song is journaled under: what removes it, so a resumed delete finds the same song in the collection
+# loaded after a crash. None when there is nothing stable to go by, like a position
+def deleteKey(cName, song):
+    if cName == 'library':
+        return (song.get('feedbackTokens') or {}).get('remove')
+    if cName == 'uploads':
+        return song.get('entityId')
+    return song.get('videoId')
+
+# journal songs to be deleted by runDeletes, leaving out the ones deleteKey has no key for
+def journalSongs(cName, songs):
+    items = [(deleteKey(cName, song), song) for song in songs]
+    skipped = sum(1 for key, song in items if key is None)
+    if skipped:
+        print(f'\tSkipping {skipped} {cName} that can not be removed')
+    journalDeletes(conn, cName, [(key, song) for key, song in items if key is not None])
+
+# delete everything journaled for a collection on a pool of threads under the shared rate limit
+# each item is marked done as soon as YT Music confirms it, so an interrupted delete can be resumed
+# library removals are sent in batches since edit_song_library_status takes a list of feedback tokens
+def runDeletes(cName, batchSize=50):
+    from tqdm import tqdm
+    pending = pendingDeletes(conn, cName)
+    if not pending:
+        return
+    if cName == 'library':
+        # songs without a remove token can not be taken out of the library
+        removable = [(key, song) for key, song in pending if song.get('feedbackTokens')]
+        markDeleted(conn, cName, [key for key, song in pending if not song.get('feedbackTokens')])
+        batches = [removable[i:i + batchSize] for i in range(0, len(removable), batchSize)]
+        func = lambda batch: limitedCall(ytmusic.edit_song_library_status, [song['feedbackTokens']['remove'] for key, song in batch])
+    elif cName == 'playlists':
+        batches = [[item] for item in pending]
+        func = lambda batch: limitedCall(ytmusic.delete_playlist, batch[0][0])
+    else:
+        batches = [[item] for item in pending]
+        func = lambda batch: makeCall(cName, batch[0][1], True)
+    deleted = set()
+    with tqdm(total=len(pending), desc=f'Deleting {cName}') as progress:
+        try:
+            for (batch,), response in runBounded(func, ((batch,) for batch in batches)):
+                keys = [key for key, item in batch]
+                markDeleted(conn, cName, keys)
+                deleted.update(keys)
+                progress.update(len(batch))
+        except Exception as err:
+            if httpStatus(err) in (401, 403):
+                print('Authorization expired. Use resetAuth, then run delete again to resume.')
+            raise
+        finally:
+            # keep the local copy in step with what was really deleted, even if the run stops early
+            forgetDeleted(cName, deleted)
+    clearJournal(conn, cName)
+
+# drop deleted items from the in memory collection and the database
+def forgetDeleted(cName, keys):
+    if not keys:
+        return
+    if cName == 'playlists':
+        playlists[:] = [p for p in playlists if p['playlistId'] not in keys]
+        savePlaylists(conn, playlists)
+        return
+    collection = collections()[cName]
+    collection[:] = [song for song in collection if deleteKey(cName, song) not in keys]
+    if cName == 'likes':
+        likes['trackCount'] = len(likes['tracks'])
+        saveLikes(conn, likes)
+    else:
+        saveCollection(conn, cName, collection)
+
+# offer to finish deletes that were interrupted by a crash or expired authorization
+def resumeDeletes():
+    unfinished = pendingDeletes(conn)
+    if not unfinished:
+        return
+    counts = {c: len(pendingDeletes(conn, c)) for c in unfinished}
+    summary = ', '.join(f'{n} {c}' for c, n in counts.items())
+    if proceed(f'A previous delete did not finish ({summary} left). Resume it?'):
+        for cName in unfinished:
+            runDeletes(cName)
+    else:
+        for cName in unfinished:
+            clearJournal(conn, cName)
 
 # call the right ytmusic function for the given collection
 def makeCall(name, song, remove):
     if remove:
         switcher = {
-            'uploads': lambda: ytmusic.delete_upload_entity(song['entityId']),
-            'library': lambda: ytmusic.edit_song_library_status(song['feedbackTokens']['remove']),
-            'likes': lambda: ytmusic.rate_song(song['videoId'], 'INDIFFERENT'),
+            'uploads': lambda: limitedCall(ytmusic.delete_upload_entity, song['entityId']),
+            'library': lambda: limitedCall(ytmusic.edit_song_library_status, song['feedbackTokens']['remove']),
+            'likes': lambda: limitedCall(ytmusic.rate_song, song['videoId'], 'INDIFFERENT'),
         }
     else:
         switcher = {
-            'uploads': lambda: ytmusic.upload_song(song),
-            'library': lambda: ytmusic.edit_song_library_status(song['feedbackTokens']['add']),
-            'likes': lambda: ytmusic.rate_song(song['videoId'], 'LIKE'),
+            'uploads': lambda: limitedCall(ytmusic.upload_song, song),
+            'library': lambda: limitedCall(ytmusic.edit_song_library_status, song['feedbackTokens']['add']),
+            'likes': lambda: limitedCall(ytmusic.rate_song, song['videoId'], 'LIKE'),
         }
 
     func = switcher.get(name, lambda: print('Invalid command.'))
@@ -283,11 +620,63 @@ def deleteAll(query):
     if query == '***':
         print('missing query')
         return
-    for name, collection in [('uploads', uploads), ('library', library), ('likes', likes['tracks'])]:
-        deleteFrom(name, collection, query)
     # user chose all, so nuke everything
     if not query:
+        plan = planDeleteAll(uploads, library, likes['tracks'])
+        counts = ', '.join(f'{len(songs)} {cName}' for (action, cName), songs in groupPlan(plan).items())
+        if plan and proceed(f'This will delete ALL songs from YT Music ({counts}, long process). Are you sure?'):
+            executePlan(plan)
         deletePlaylist(None)
+        return
+    songMB = queryMBdata(query)
+    for name, collection in collections().items():
+        deleteFrom(name, collection, query, songMB)
+
+# the MusicBrainz data smart playlists looked up, when a query has year or genre terms
+def queryMBdata(query):
+    try:
+        needed = usesMBdata(compileQuery([q for q in query if q != '-e'], wordRatio, phraseRatio))
+    except ValueError:
+        return None
+    return loadMBdata(conn) if needed else None
+
+# print the songs that match query from every collection without changing anything
+# each collection is searched in chunks, so the first songs show up before a large library is done
+def searchSongs(query):
+    if not query:
+        print('missing query')
+        return
+    exact = '-e' in query
+    query = [q for q in query if q != '-e']
+    try:
+        plan = compileQuery(query, wordRatio, phraseRatio, exact)
+    except ValueError as err:
+        print(f'Invalid query: {err}')
+        return
+    songMB = loadMBdata(conn) if usesMBdata(plan) else None
+    found = 0
+    for cName, collection in collections().items():
+        if not collection:
+            continue
+        aKey = 'artist' if 'artist' in collection[0].keys() else 'artists'
+        matched = 0
+        for song in runQuery(plan, collection, songMB, 2000):
+            if not matched:
+                print(f'\n\t{cName}:')
+            print(songLine(song, aKey), flush=True)
+            matched += 1
+        found += matched
+    print(f'\nFound {found} songs')
+
+# delete uploads that have the same title and artist as a song in your library
+def deleteDuplicates():
+    plan = planDuplicateUploads(buildIndexes(uploads, library, likes['tracks']))
+    if not plan:
+        print('No uploads are duplicated by songs in your library')
+        return
+    printSongs(f'\n\tFound {len(plan)} uploads that are already in your library:', [song for action, cName, song in plan])
+    if proceed('Are you sure you want to delete these uploads?'):
+        executePlan(plan)
 
 # choose which function to call based on user command
 def deleteOptions(command, query):
@@ -297,7 +686,8 @@ def deleteOptions(command, query):
         'library': lambda: deleteFrom('library', library, None),
         'likes': lambda: deleteFrom('likes', likes['tracks'], None),
         'playlist': lambda: deletePlaylist(query),
-        'query': lambda: deleteAll(query)
+        'query': lambda: deleteAll(query),
+        'duplicates': lambda: deleteDuplicates()
     }
 
     func = switcher.get(command, lambda: print('Invalid command.'))
@@ -306,12 +696,16 @@ def deleteOptions(command, query):
 def commandOptions(command, query):
     switcher = {
         '-d': lambda: loadDir(query[0]),
-        '-p': lambda: loadPlaylist(query[0]),
+        'watch': lambda: watchDirs(query),
+        '-p': lambda: loadPlaylist(query),
         'likes': lambda: addLikes(),
         'smart': lambda: smartPlaylists(),
         'delete': lambda: deleteThis(query),
         'config': lambda: configOptions(query),
-        'resetAuth': lambda: authenticate(True)
+        'resetAuth': lambda: authenticate(True),
+        'upload': lambda: drainUploads(),
+        'mbimport': lambda: importMB(query),
+        'search': lambda: searchSongs(query)
     }
 
     func = switcher.get(command, lambda: printHelp())
@@ -334,67 +728,362 @@ def printHelp():
         print(f'\t{line}')
 
 # user passed a directory so process all the music files in it
+# tags are read by a pool of processes while this process matches and searches the results
 def loadDir(query):
     if os.path.isdir(query):
-        for dirName, subdirList, fileList in os.walk(query):
-            for filename in fileList:
-                processFile(os.path.join(dirName,filename))
+        # manifest keys are absolute, like the paths playlists and watch give, whatever directory the scan runs from
+        query = os.path.abspath(query)
+        seen = set()
+        # unchanged files never reach the tag readers
+        paths = unresolvedFiles(walkMusic(query, seen))
+        # matching, searching and adding run on a pool of threads under the shared rate limit
+        for filename, videoId in processUnique(readTagsParallel(paths, scanWorkers)):
+            pass
+        pruneManifest(query, seen)
     else:
         print(f'Invalid directory: {query}')
 
-def updatePlaylist(name, tracks):
+# every file under root, which is also added to seen
+def walkMusic(root, seen):
+    for dirName, subdirList, fileList in os.walk(root):
+        for filename in fileList:
+            path = os.path.join(dirName, filename)
+            seen.add(path)
+            yield path
+
+# drop the manifest entries of files under root that are gone, so deleted and renamed files do not pile up
+# seen: the files a scan of root just found, otherwise every entry under root is looked for on disk
+def pruneManifest(root, seen=None):
+    if not os.path.isdir(root):
+        return
+    prefix = os.path.join(root, '')
+    with manifestLock:
+        gone = [name for name in manifest if name.startswith(prefix) and (name not in seen if seen is not None else not os.path.exists(name))]
+        for name in gone:
+            del manifest[name]
+    if gone:
+        print(f'Forgot {len(gone)} files that are no longer in {root}')
+
+# keep adding the music files that appear under the music folders until stopped with Ctrl+C
+# files are matched, searched and uploaded in batches as they are written, see fileWatcher, while the collections,
+# indexes, manifest and search cache stay in memory. the collections are brought up to date every watchrefresh
+# minutes, also while no files are coming in
+def watchDirs(query):
+    roots = [os.path.abspath(os.path.expanduser(r)) for r in query or json.loads(config['DEFAULT'].get('musicroots', '[]'))]
+    if not roots:
+        print('No folders to watch. Give them on the command line or set musicroots in config, like ["~/Music"]')
+        return
+    invalid = [r for r in roots if not os.path.isdir(r)]
+    if invalid:
+        print(f'Invalid directory: {", ".join(invalid)}')
+        return
+    refresh = config['DEFAULT'].getfloat('watchrefresh', 60) * 60
+    # the watcher is opened before the catch up, so files written while it runs are still reported after it
+    watcher = openWatcher(roots, config['DEFAULT'].getfloat('watchpoll', 30))
+    try:
+        # files added while nothing was watching are caught up first, the manifest skips the rest without reading them
+        for root in roots:
+            loadDir(root)
+        saveState()
+        refreshed = time.monotonic()
+        print(f'Watching {", ".join(roots)} for new music, press Ctrl+C to stop')
+        for batch in watchBatches(watcher, config['DEFAULT'].getfloat('watchdebounce', 2), idle=refresh):
+            if time.monotonic() - refreshed >= refresh:
+                loadCollections(['uploads', 'library', 'likes'])
+                # the watcher does not report deleted files
+                for root in roots:
+                    pruneManifest(root)
+                refreshed = time.monotonic()
+            if not batch:
+                continue
+            count('watch_batches')
+            files = list(unresolvedFiles(batch))
+            if not files:
+                continue
+            print(f'Syncing {len(files)} new or changed files')
+            with stage('watch_batch'):
+                for filename, videoId in processUnique(readTagsParallel(files, scanWorkers)):
+                    pass
+                saveState()
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        watcher.close()
+
+# make the playlist contain exactly the given tracks, creating it if needed
+# the track list is cached and only downloaded again when the count YT Music reports no longer matches
+def updatePlaylist(name, tracks, chunkSize=100):
     tracks = set(tracks)
     pName = next((p for p in playlists if p['title'] == name), None)
-    pListID = ytmusic.create_playlist(name, '') if not pName else pName['playlistId']
-    print(f'Downloading track list for playlist "{name}"')
-    tempPlist = ytmusic.get_playlist(pListID, 10000)
-    existing = set([t['videoId'] for t in tempPlist['tracks']])
-    tracks -= existing
-    if tracks:
-        print(f'Adding {len(tracks)} songs to playlist "{name}"')
-        ytmusic.add_playlist_items(pListID,tracks,None,False)
-
-# process playlist file
-def loadPlaylist(query):
-    if os.path.isfile(query):
-        with openFile(query, 'r') as (playlist, err):
-            if err:
-                print(f'Problem opening playlist file: {err}')
-                return
-            lines = playlist.readlines()
-            plistName = os.path.splitext(os.path.basename(playlist.name))[0]
-
-            for line in lines:
-                # skip comment lines in the playlist file
-                if line.startswith('#'):
-                    continue
-                videoId = processFile(line.strip())
-                if videoId:
-                    playlistItems.add(videoId)
-
-            updatePlaylist(plistName,playlistItems)
+    if not pName:
+        if not tracks:
+            return
+        pListID = limitedCall(ytmusic.create_playlist, name, '')
+        pName = {'title': name, 'playlistId': pListID, 'count': '0'}
+        playlists.append(pName)
+        existing, trackCount = [], 0
     else:
-        print(f'{query} is not a valid file.')
+        pListID = pName['playlistId']
+        existing, trackCount = loadPlaylistTracks(conn, pListID)
+        if existing is None or str(trackCount) != str(pName.get('count', '')).replace(',', ''):
+            print(f'Downloading track list for playlist "{name}"')
+            with stage('playlist_download'):
+                tempPlist = limitedCall(ytmusic.get_playlist, pListID, 10000)
+            existing = [{'videoId': t['videoId'], 'setVideoId': t.get('setVideoId')} for t in tempPlist['tracks'] if t.get('videoId')]
+            trackCount = tempPlist.get('trackCount') or len(existing)
+    existingIds = {t['videoId'] for t in existing}
+    removeTracks = [t for t in existing if t['videoId'] not in tracks]
+    addTracks = sorted(tracks - existingIds)
+
+    try:
+        if removeTracks:
+            print(f'Removing {len(removeTracks)} songs from playlist "{name}"')
+        for i in range(0, len(removeTracks), chunkSize):
+            chunk = removeTracks[i:i + chunkSize]
+            with stage('playlist_remove'):
+                response = limitedCall(ytmusic.remove_playlist_items, pListID, chunk)
+            if 'SUCCEEDED' not in str(response):
+                raise Exception(f'Could not remove songs from playlist "{name}": {response}')
+            removed = {t['setVideoId'] for t in chunk}
+            existing = [t for t in existing if t['setVideoId'] not in removed]
+            trackCount -= len(chunk)
+        if addTracks:
+            print(f'Adding {len(addTracks)} songs to playlist "{name}"')
+        for i in range(0, len(addTracks), chunkSize):
+            chunk = addTracks[i:i + chunkSize]
+            with stage('playlist_add'):
+                response = limitedCall(ytmusic.add_playlist_items, pListID, chunk, None, False)
+            if not isinstance(response, dict) or 'SUCCEEDED' not in response.get('status', ''):
+                raise Exception(f'Could not add songs to playlist "{name}": {response}')
+            existing += [r for r in response.get('playlistEditResults', []) if r]
+            trackCount += len(chunk)
+    except Exception as err:
+        # the cached list no longer matches YT Music, so download it next time
+        print(err)
+        dropPlaylistTracks(conn, pListID)
+        return
+    savePlaylistTracks(conn, pListID, existing, trackCount)
+    pName['count'] = str(trackCount)
+
+# import playlist files, or every playlist under a directory, in one pass
+# the files they list are resolved together and only once however many playlists share them,
+# then every playlist is updated with its own songs
+def loadPlaylist(query):
+    playlistTracks = {}
+    for filename in findPlaylists(query or []):
+        files = readPlaylist(filename)
+        if files is not None:
+            # playlists with the same name in different folders end up in one YT Music playlist
+            playlistTracks.setdefault(playlistName(filename), []).extend(files)
+    if not playlistTracks:
+        print('No playlists to import')
+        return
+    unique = list(dict.fromkeys(f for files in playlistTracks.values() for f in files))
+    print(f'Resolving {len(unique)} files from {len(playlistTracks)} playlists')
+    resolveFiles(unique)
+    for name, files in playlistTracks.items():
+        updatePlaylist(name, [resolvedFiles[f] for f in files if resolvedFiles.get(f)])
+
+# run files through processFile and remember their videoIds in resolvedFiles
+# files the manifest still knows skip the tag readers, the rest are read by the pool like in loadDir
+def resolveFiles(files):
+    pending = [f for f in files if f not in resolvedFiles]
+    known = [f for f in pending if unchangedEntry(f)]
+    knownSet = set(known)
+    unknown = (f for f in pending if f not in knownSet)
+    items = itertools.chain(((f,) for f in known), readTagsParallel(unknown, scanWorkers))
+    for filename, videoId in processUnique(items):
+        resolvedFiles[filename] = videoId
+
+# run (filename, track) items through processFile and yield each filename with its result
+# only the first copy of a recording is matched, searched or uploaded. copies that turn up later in the scan,
+# or that match a file an earlier scan resolved, share its result once it is known
+def processUnique(items):
+    leaders = audioLeaders()
+    copies = []
+    for item, videoId in runBounded(processFile, firstCopies(items, leaders, copies)):
+        track = item[1] if len(item) > 1 else None
+        if track and item[0] in manifest:
+            with manifestLock:
+                manifest[item[0]]['audioHash'] = track.get('audioHash')
+        yield item[0], videoId
+    for filename, track, leader in copies:
+        yield filename, shareResult(filename, track, leader)
+
+# the file each audio hash was last resolved from, for the manifest entries whose result still holds
+def audioLeaders():
+    leaders = {}
+    for filename, entry in manifest.items():
+        if entry.get('audioHash') and (entry['status'] in ('found', 'uploaded', 'queued') or entry['status'] == 'missing' and not uploadSongs):
+            leaders[entry['audioHash']] = filename
+    return leaders
+
+# pass on the items whose audio has not been seen yet and set the others aside in copies
+def firstCopies(items, leaders, copies):
+    for item in items:
+        fileHash = item[1].get('audioHash') if len(item) > 1 and item[1] else None
+        leader = leaders.get(fileHash)
+        if leader and leader != item[0]:
+            copies.append((item[0], item[1], leader))
+            continue
+        if fileHash:
+            leaders[fileHash] = item[0]
+        yield item
+
+# give a copy the manifest entry of the file with the same audio, or process it after all when that has no usable result
+def shareResult(filename, track, leader):
+    entry = manifest.get(leader)
+    if not entry or entry['status'] not in ('found', 'uploaded', 'queued', 'missing'):
+        return processFile(filename, track)
+    if entry['status'] == 'found' and entry['videoId'] not in knownIds:
+        return processFile(filename, track)
+    # the copy may be tagged well enough to be found where the first one was not
+    if entry['status'] == 'missing' and (uploadSongs or not sameTags(entry, track)):
+        return processFile(filename, track)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return processFile(filename, track)
+    print(f'\t{filename} has the same audio as {leader}')
+    info = dict(entry['info'], filename=filename) if entry['info'] else None
+    # no tag hash, so a copy that is touched later is matched again
+    recordFile(filename, stat, None, entry['status'], entry['videoId'], info, entry.get('audioHash'))
+    count('audio_copies', status=entry['status'])
+    if entry['status'] == 'missing':
+        addNotFound(info)
+    return entry['videoId'] if entry['status'] == 'found' else False
+
+# whether a copy has the tags the file it shares its audio with was looked up by. the tag hash covers title, artist
+# and album. a leader that is a copy itself has no tag hash, so its title and artist are compared instead
+def sameTags(entry, track):
+    info = entry['info']
+    if not info or not info['artist'] or not info['title']:
+        return False
+    artist = track['artist'].split(' feat.')[0] if track['artist'] else ''
+    if entry.get('tagHash'):
+        return entry['tagHash'] == tagHash(artist, track['title'], track['album'], track['length'])
+    return (info['title'], info['artist']) == (track['title'], artist)
 
 # add all liked songs to library
 def addLikes():
-    for song in likes['tracks']:
-        # search library for track and skip if it is already there
-        if next((s for s in library if s['videoId'] == song['videoId']), None):
-            print(f'SKIPPING "{song["title"]}" by {song["artists"][0]["name"]}: {song["duration"]}')
-            continue
-        # make sure the song can be added to the library
-        if 'feedbackTokens' in song.keys():
-            print(f'Adding song "{song["title"]}" by {song["artists"][0]["name"]}: {song["duration"]}')
-            makeCall('library', song, False)
-        # assume the song is a video
+    plan, videos = planLikes(buildIndexes(uploads, library, likes['tracks']))
+    print(f'SKIPPING {len(likes["tracks"]) - len(plan) - len(videos)} liked songs that are already in your library')
+    # songs without feedback tokens can not be added, assume they are videos
+    for song in videos:
+        print(f'"{song["title"]}" by {song["artists"][0]["name"]}: {song.get("duration")} is a video')
+    executePlan(plan)
+
+# carry out a plan from reconcile, batching whatever the API accepts as a list
+# removals go through the delete journal so they can be resumed
+def executePlan(plan, batchSize=50):
+    from tqdm import tqdm
+    for (action, cName), songs in groupPlan(plan).items():
+        if action == 'remove':
+            journalSongs(cName, songs)
+            runDeletes(cName)
+        elif cName == 'library':
+            print(f'Adding {len(songs)} songs to your library')
+            batches = ((songs[i:i + batchSize],) for i in range(0, len(songs), batchSize))
+            addTokens = lambda batch: limitedCall(ytmusic.edit_song_library_status, [song['feedbackTokens']['add'] for song in batch])
+            for (batch,), response in tqdm(runBounded(addTokens, batches), total=-(-len(songs) // batchSize)):
+                library[:0] = batch
+                knownIds.update(song['videoId'] for song in batch)
+            saveCollection(conn, 'library', library)
         else:
-            print(f'"{song["title"]}" by {song["artists"][0]["name"]}: {song["duration"]} is a video')
+            for song, response in runBounded(makeCall, ((cName, song, False) for song in songs)):
+                pass
+
+# set up the MusicBrainz client the first time a command needs it
+def setupMusicBrainz():
+    import musicbrainzngs
+    musicbrainzngs.set_useragent(
+        'Youtube Music Sync',
+        appVer,
+        ''
+    )
+    musicbrainzngs.set_hostname(config['DEFAULT'].get('mbhost', 'musicbrainz.org'))
+    musicbrainzngs.set_rate_limit(1, config['DEFAULT'].getfloat('mbrateLimit', 1))
+    instrument(musicbrainzngs, 'musicbrainz', ['search_recordings', 'get_recording_by_id', 'get_work_by_id'])
+
+# bring the collections in names up to date and index them for matching, see loadCache
+def loadCollections(names):
+    global uploads
+    global library
+    global playlists
+    global likes
+    global libraryIndex
+    global uploadsIndex
+    global knownIds
+
+    uploads, library, playlists, likes = loadCache(ytmusic, conn, authFile, fullSync, config['DEFAULT'].getfloat('fullsyncdays', 7), names)
+    # keep compact records instead of the full responses for the rest of the run
+    uploads = buildRecords(uploads)
+    library = buildRecords(library)
+    likes['tracks'] = buildRecords(likes['tracks'])
+    # index the titles once so each scanned file only fuzzy matches a short list of songs
+    libraryIndex = buildIndex(library)
+    uploadsIndex = buildIndex(uploads)
+    knownIds = {s['videoId'] for s in library + uploads + likes['tracks'] if s.get('videoId')}
+
+# write what the run has learned so far, the watch command does this after every batch
+def saveState():
+    commitStore(conn)
+    with manifestLock:
+        saveManifest(manifestFile, manifest)
+    saveSearchCache(searchFile, searchCache)
+
+# load only what the command needs, see commandNeeds
+def loadState(command):
+    global conn
+    global manifest
+    global searchCache
+    global mbIndex
+
+    needs = commandNeeds.get(command, set())
+    if 'ytmusic' in needs:
+        authenticate()
+    if 'store' in needs:
+        conn = openStore(dbFile)
+        migratePickles(conn, cacheFile, MBfile, missFile, convertMBdata)
+    names = [name for name in ('uploads', 'library', 'playlists', 'likes') if name in needs]
+    # without a client the collections are only read from the database
+    if names:
+        loadCollections(names)
+    if 'scan' in needs:
+        with stage('cache_load'):
+            manifest = loadManifest(manifestFile)
+            searchCache = loadSearchCache(searchFile)
+        # the manifest resolves files left in the queue as queued without processing them, so their uploads
+        # are started here rather than when the scan queues a new file
+        if uploadSongs and leftoverUploads(conn, config['DEFAULT'].getint('uploadattempts', 5)):
+            startUploadWorkers()
+    if 'musicbrainz' in needs:
+        setupMusicBrainz()
+        mbIndex = openMBindex(mbIndexFile)
+        configureMBcache(conn, config['DEFAULT'].getfloat('mbcachedays', 90))
+
+# build the offline MusicBrainz index from one or more dumps, see mbIndex for the formats
+def importMB(query):
+    if not query:
+        print('Give the MusicBrainz dump files to import')
+        return
+    missing = [d for d in query if not os.path.isfile(d)]
+    if missing:
+        print(f'{", ".join(missing)} not found')
+        return
+    imported = importDumps(str(mbIndexFile), query)
+    print(f'Imported {imported} recordings into {mbIndexFile}')
+    # songs MusicBrainz did not know may be in the new index, so look them up again
+    clearMBmisses(conn)
+
+# the song collections by the names reconcile and the delete journal use
+def collections():
+    return {'uploads': uploads, 'library': library, 'likes': likes['tracks']}
 
 # create or update the smart playlists from the config file
 def smartPlaylists():
     global config
-    MBdata = fillMBdata(cacheFile, config, MBfile, [('uploads', uploads), ('library', library), ('likes', likes['tracks'])])
+    MBdata = fillMBdata(conn, config, [('uploads', uploads), ('library', library), ('likes', likes['tracks'])], mbIndex)
     libraryPlists = config.sections() or []
     smartPlaylists = []
 
@@ -402,40 +1091,11 @@ def smartPlaylists():
         print('No smart playlists found in config')
         exit(0)
     rules = {n:getRule(config[n]) for n in libraryPlists}
-    addTracks = {n:[] for n in libraryPlists}
-    for videoId, song in tqdm(MBdata.items()):
-        for pName in libraryPlists:
-            if 'year' in rules[pName].keys() and 'year' in song.keys() and song['year'] and int(song['year']) in rules[pName]['year']:
-                if 'genre' in rules[pName].keys() and 'genres' in song.keys() and song['genres']:
-                    #if common_member(song['genres'], rules[pName]['genre']):
-                    if [r for r in rules[pName]['genre'] for g in song['genres'] if r in g]:
-                        #if common_member(rules[pName]['notGenre'], song['genres']):
-                        if [r for r in rules[pName]['notGenre'] for g in song['genres'] if r in g]:
-                            continue
-                        # track matches all rules so add it to playlist
-                        addTracks[pName].append(videoId)
-                        # we are done processing this playlist for this track
-                        continue
-                else:
-                    if [r for r in rules[pName]['notGenre'] for g in song['genres'] if r in g]:
-                        continue
-                    # track matches all rules present (no genre rules)
-                    addTracks[pName].append(videoId)
-                    continue
-            if 'genre' in rules[pName].keys() and 'genres' in song.keys() and song['genres']:
-                if [r for r in rules[pName]['genre'] for g in song['genres'] if r in g]:
-                    if [r for r in rules[pName]['notGenre'] for g in song['genres'] if r in g]:
-                        continue
-                    if 'year' in rules[pName].keys() and 'year' in song.keys() and song['year']:
-                        if int(song['year']) in rules[pName]['year']:
-                            addTracks[pName].append(videoId)
-                            continue
-                    else:
-                        addTracks[pName].append(videoId)
-    # add collected sonngs
+    # every rule is evaluated at once with set operations over an index of MBdata
+    addTracks = compileRules(rules, MBdata)
+    # add collected songs, playlists with no matches are still updated so old songs get removed
     for name, tracks in addTracks.items():
-        if tracks:
-            updatePlaylist(name,tracks)
+        updatePlaylist(name,tracks)
 
 # delete items from YT Music
 def deleteThis(query):
@@ -444,6 +1104,7 @@ def deleteThis(query):
         print('Nothing to delete. Please specify what to delete')
         print(*deleteHelp, sep='\n')
         exit(0)
+    resumeDeletes()
     # differentiate between None for deleting everything and user forgetting the query
     deleteCommand = query[0]
     if deleteCommand == 'playlist':
@@ -453,27 +1114,34 @@ def deleteThis(query):
     deleteOptions(deleteCommand, query)
 
 
-loadConfig()
-authenticate()
-sys.excepthook = myExceptHandler
-# setMB(config, appVer)
-uploads, library, playlists, likes = loadCache(ytmusic, cacheFile)
-commandOptions(firstArg, sys.argv[2:] or None)
+if __name__ == '__main__':
+    # tag reader processes import this file again, so only run commands in the main process
+    multiprocessing.freeze_support()
+    loadConfig()
+    sys.excepthook = myExceptHandler
+    # setMB(config, appVer)
+    loadState(firstArg)
+    commandOptions(firstArg, sys.argv[2:] or None)
+    # the scan is done, but queued uploads keep going until they finish
+    finishUploads()
 
-# make a csv file containing songs that could not be found on YT music
-if notFound:
-    fieldNames = notFound[0].keys() # ['Title','Artist','Duration','Filename']
+    # make a csv file containing songs that could not be found on YT music
+    if notFound:
+        fieldNames = next(iter(notFound.values())).keys() # ['Title','Artist','Duration','Filename']
 
-    with openFile('missing.csv', 'w') as (csvFile, err):
-        if err:
-            print(f'Problem opening csv file: {err}')
-        else:
-            missing = csv.DictWriter(csvFile, fieldnames=fieldNames)
-            missing.writeheader()
+        with openFile('missing.csv', 'w') as (csvFile, err):
+            if err:
+                print(f'Problem opening csv file: {err}')
+            else:
+                missing = csv.DictWriter(csvFile, fieldnames=fieldNames)
+                missing.writeheader()
 
-            for song in notFound:
-                missing.writerow(song)
+                for song in notFound.values():
+                    missing.writerow(song)
 
-saveCache(cacheFile, MBfile, MBdata, [uploads, library, playlists, likes])
-# print a bell character to the terminal to let the user know the process is complete
-print('\a')
+    with stage('cache_save'):
+        saveState()
+    # time and call counts for the whole run, for tracking cron jobs
+    writeMetrics(metricsFile, promFile, command=firstArg or 'help', outcome='ok')
+    # print a bell character to the terminal to let the user know the process is complete
+    print('\a')